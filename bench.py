@@ -0,0 +1,268 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import subprocess
+import statistics
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageDraw
+import PIL
+
+import main
+
+# Cover sizes (longest side) used for the synthetic avatars
+AVATAR_SIZES = [320, 640, 1280, 2560, 4000]
+
+# Synopsis lengths in words
+SYNOPSIS_WORDS = [20, 120, 400]
+
+WORDS = (
+    "the young pirate sets sail across a vast ocean searching for a legendary treasure "
+    "while rival crews navy admirals and ancient powers stand in the way of his dream"
+).split()
+
+def make_cover(long_side, seed):
+    """Build a noisy JPEG cover so the decoder has real work to do."""
+    rng = random.Random(seed)
+    width, height = long_side, long_side * 3 // 4
+    img = Image.effect_noise((width, height), 64).convert('RGB')
+    draw = ImageDraw.Draw(img)
+    for _ in range(20):
+        x, y = rng.randrange(width), rng.randrange(height)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x, y, x + width // 5, y + height // 5), fill=color)
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+def make_sessions(covers):
+    """One session per TEMPLATES x COLORS x FONTS combination, cycling synopsis lengths and covers."""
+    sessions = []
+    colors = [value for value in main.COLORS.values() if value.startswith('#')]
+    cover_sizes = sorted(covers)
+    for template in main.TEMPLATES.values():
+        for color in colors:
+            for font in main.FONTS.values():
+                index = len(sessions)
+                words = SYNOPSIS_WORDS[index % len(SYNOPSIS_WORDS)]
+                cover_size = cover_sizes[index % len(cover_sizes)]
+                sessions.append({
+                    'manga_name': f"Benchmark Manga {index}",
+                    'synopsis': " ".join(WORDS[i % len(WORDS)] for i in range(words)),
+                    'percentage': index % 101,
+                    'year': 1990 + index % 35,
+                    'author': "Bench Author",
+                    'template_style': template,
+                    'color_scheme': color,
+                    'text_style': font,
+                    'branding': "bench",
+                    'manga_pfp': covers[cover_size],
+                    'cover_size': cover_size,
+                })
+    return sessions
+
+def clear_caches():
+    """Drop every process-wide render cache so the next render runs cold."""
+    main.font_registry = main.FontRegistry(main.FONT_CACHE_SIZE)
+    main.static_layers = main.StaticLayerCache(main.STATIC_LAYER_CACHE_SIZE)
+    main.circle_mask.cache_clear()
+    main.text_width.cache_clear()
+    main.line_height.cache_clear()
+    main.fit_text.cache_clear()
+    main.gradient_background.cache_clear()
+    main.grain_texture.cache_clear()
+    main.glow_mask.cache_clear()
+
+def summarize(samples_ms):
+    ordered = sorted(samples_ms)
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+    return {
+        'count': len(ordered),
+        'mean_ms': round(statistics.fmean(ordered), 3),
+        'p50_ms': round(pct(50), 3),
+        'p95_ms': round(pct(95), 3),
+        'p99_ms': round(pct(99), 3),
+        'max_ms': round(ordered[-1], 3),
+    }
+
+def time_call(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return (time.perf_counter() - start) * 1000, result
+
+def bench_normalize(covers, repeat):
+    """Time normalize_avatar for each raw cover size."""
+    avatar_size = max(main.TEMPLATE_AVATAR_SIZES.values())
+    results = {}
+    for cover_size, cover in sorted(covers.items()):
+        samples = [time_call(main.normalize_avatar, cover, avatar_size)[0] for _ in range(repeat)]
+        results[str(cover_size)] = summarize(samples)
+    return results
+
+def bench_render(sessions, repeat):
+    """Render every session cold (caches cleared each time), then warm ``repeat`` times."""
+    cold = []
+    for data in sessions:
+        clear_caches()
+        cold.append(time_call(main.generate_thumbnail, None, data)[0])
+
+    warm = []
+    sizes = []
+    by_cover = {}
+    for _ in range(repeat):
+        for data in sessions:
+            elapsed, image = time_call(main.generate_thumbnail, None, data)
+            warm.append(elapsed)
+            sizes.append(len(image))
+            by_cover.setdefault(str(data['cover_size']), []).append(elapsed)
+
+    return {
+        'cold': summarize(cold),
+        'warm': summarize(warm),
+        'warm_by_cover_size': {size: summarize(samples) for size, samples in sorted(by_cover.items())},
+        'throughput_per_core': round(1000 / statistics.fmean(warm), 2),
+        'encoded_bytes': {
+            'mean': int(statistics.fmean(sizes)),
+            'p50': int(statistics.median(sizes)),
+            'max': max(sizes),
+        },
+    }
+
+def bench_encoders(sessions, repeat, max_bytes, samples=20):
+    """Encode rendered thumbnails with every format and preset, with and without a byte budget."""
+    step = max(1, len(sessions) // samples)
+    masters = [
+        Image.open(BytesIO(main.generate_thumbnail(None, data, 'PNG'))).convert('RGB')
+        for data in sessions[::step][:samples]
+    ]
+    results = {}
+    for image_format in main.OUTPUT_FORMATS:
+        for preset in main.ENCODER_PRESETS:
+            budgets = [0] if image_format == 'PNG' else [0, max_bytes]
+            for budget in budgets:
+                times, sizes = [], []
+                for _ in range(repeat):
+                    for master in masters:
+                        elapsed, encoded = time_call(
+                            main.encode_image, master, image_format, main.THUMBNAIL_QUALITY, preset, budget
+                        )
+                        times.append(elapsed)
+                        sizes.append(len(encoded))
+                name = f"{image_format}/{preset}" + (f"/max{budget}" if budget else "")
+                results[name] = {
+                    'mean_ms': round(statistics.fmean(times), 3),
+                    'p95_ms': summarize(times)['p95_ms'],
+                    'mean_bytes': int(statistics.fmean(sizes)),
+                    'max_bytes': max(sizes),
+                }
+    return results
+
+def _render_many(sessions):
+    for data in sessions:
+        main.generate_thumbnail(None, data)
+    return len(sessions)
+
+def bench_parallel(sessions, workers, repeat):
+    """Render all sessions on ``workers`` processes and report throughput per worker."""
+    chunks = [sessions[i::workers] for i in range(workers)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Warm each worker up before measuring
+        list(executor.map(_render_many, [chunk[:5] for chunk in chunks]))
+        start = time.perf_counter()
+        rendered = 0
+        for _ in range(repeat):
+            rendered += sum(executor.map(_render_many, chunks))
+        elapsed = time.perf_counter() - start
+    return {
+        'workers': workers,
+        'renders': rendered,
+        'throughput': round(rendered / elapsed, 2),
+        'throughput_per_worker': round(rendered / elapsed / workers, 2),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new, path=""):
+    """Print latency and size changes between two result files."""
+    for key, value in new.items():
+        if key == 'meta':
+            continue
+        old_value = old.get(key) if isinstance(old, dict) else None
+        if isinstance(value, dict):
+            compare(old_value or {}, value, f"{path}{key}.")
+        elif isinstance(value, (int, float)) and isinstance(old_value, (int, float)) and old_value:
+            change = (value - old_value) / old_value * 100
+            print(f"{path}{key:<20} {old_value:>12} -> {value:<12} ({change:+.1f}%)")
+
+def main_cli(argv):
+    parser = argparse.ArgumentParser(description="Benchmark generate_thumbnail without Telegram.")
+    parser.add_argument('-o', '--output', default='bench_results.json', help="where to write the JSON results")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="warm passes over all sessions")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1,
+                        help="processes for the parallel throughput run (0 to skip)")
+    parser.add_argument('--max-bytes', type=int, default=50000,
+                        help="byte budget for the size-target encoder runs")
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+
+    # Keep the per-render font warnings out of the timings
+    main.logger.setLevel('ERROR')
+
+    covers = {size: make_cover(size, seed=size) for size in AVATAR_SIZES}
+    avatar_size = max(main.TEMPLATE_AVATAR_SIZES.values())
+    raw_sessions = make_sessions(covers)
+    # The bot stores normalized avatars, so render from those
+    normalized = {size: main.normalize_avatar(cover, avatar_size) for size, cover in covers.items()}
+    sessions = [dict(data, manga_pfp=normalized[data['cover_size']]) for data in raw_sessions]
+    print(f"{len(sessions)} sessions, avatar sizes {AVATAR_SIZES}")
+
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'cpu_count': os.cpu_count(),
+            'sessions': len(sessions),
+            'repeat': args.repeat,
+        },
+        'normalize_avatar': bench_normalize(covers, args.repeat),
+        'render': bench_render(sessions, args.repeat),
+        'encoders': bench_encoders(sessions, args.repeat, args.max_bytes),
+    }
+    if args.workers > 0:
+        results['parallel'] = bench_parallel(sessions, args.workers, args.repeat)
+    # ru_maxrss is in kilobytes on Linux
+    results['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    render = results['render']
+    print(f"cold p50 {render['cold']['p50_ms']}ms, warm p50/p95/p99 "
+          f"{render['warm']['p50_ms']}/{render['warm']['p95_ms']}/{render['warm']['p99_ms']}ms")
+    print(f"{render['throughput_per_core']} renders/s per core, peak RSS {results['peak_rss_mb']} MB")
+    for name, encoder in results['encoders'].items():
+        print(f"  {name:<24} {encoder['mean_ms']:>8.2f}ms {encoder['mean_bytes']:>9} bytes")
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main_cli(sys.argv[1:])
@@ -1,6 +1,8 @@
 import os
 import logging
 import json
+import time
+import functools
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
     Updater, CommandHandler, MessageHandler, Filters, ConversationHandler, CallbackContext
@@ -10,9 +12,11 @@ import textwrap
 import requests
 from io import BytesIO
 import re
-from datetime import datetime
 import random
 import glob
+import threading
+import hashlib
+from collections import OrderedDict
 
 # Enable logging
 logging.basicConfig(
@@ -74,17 +78,243 @@ FONT_SIZES = {
     "branding": 20
 }
 
-# User session data (in production, use a database)
-user_sessions = {}
+# Directory holding the template background images
+TEMPLATES_DIR = "templates"
+
+# Limits for uploaded custom fonts
+MAX_FONT_BYTES = int(os.getenv('MAX_FONT_BYTES', 5 * 1024 * 1024))
+FONT_CACHE_BYTES = int(os.getenv('FONT_CACHE_BYTES', 50 * 1024 * 1024))
+
+# Leading bytes of TrueType ("\0\1\0\0" or "true") and OpenType ("OTTO") files
+FONT_SIGNATURES = (b'\x00\x01\x00\x00', b'true', b'OTTO')
+
+# Session expiry settings
+SESSION_TTL = float(os.getenv('SESSION_TTL', 3600))
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_BYTES', 64 * 1024 * 1024))
+SESSION_SWEEP_INTERVAL = float(os.getenv('SESSION_SWEEP_INTERVAL', 30))
+
+class SessionStore:
+    """In-memory user sessions with idle expiry and a memory cap.
+
+    Sessions are kept in order of last activity. A sweep drops sessions idle
+    for longer than ``ttl`` and then the least recently active ones until the
+    bytes held fall under ``max_bytes``. Sweeps run on every new session and
+    at most every ``sweep_interval`` seconds on lookups.
+    """
+
+    def __init__(self, ttl, max_bytes, sweep_interval):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.expired = 0
+        self.evicted = 0
+        self._sessions = OrderedDict()
+        self._last_sweep = time.time()
+
+    def new(self, user_id):
+        """Start a fresh session for a user and return it."""
+        now = time.time()
+        session = {'data': {}, 'created_at': now, 'last_activity': now}
+        self._sessions.pop(user_id, None)
+        self._sessions[user_id] = session
+        self.sweep()
+        return session
+
+    def __contains__(self, user_id):
+        return user_id in self._sessions
+
+    def __getitem__(self, user_id):
+        session = self._sessions[user_id]
+        session['last_activity'] = time.time()
+        self._sessions.move_to_end(user_id)
+        if session['last_activity'] - self._last_sweep > self.sweep_interval:
+            self.sweep()
+        return session
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def pop(self, user_id, default=None):
+        return self._sessions.pop(user_id, default)
+
+    @staticmethod
+    def session_size(session):
+        """Approximate bytes held by a session's text and image data."""
+        return sum(len(value) for value in session['data'].values() if isinstance(value, (bytes, str)))
+
+    def bytes_held(self):
+        return sum(self.session_size(session) for session in self._sessions.values())
+
+    def sweep(self):
+        """Drop idle sessions, then the oldest ones while over the memory cap."""
+        now = time.time()
+        self._last_sweep = now
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if now - session['last_activity'] <= self.ttl:
+                break
+            del self._sessions[user_id]
+            self.expired += 1
+        
+        held = self.bytes_held()
+        # Never evict the session that is currently active
+        while held > self.max_bytes and len(self._sessions) > 1:
+            _, session = self._sessions.popitem(last=False)
+            held -= self.session_size(session)
+            self.evicted += 1
+
+    def stats(self):
+        return {
+            'sessions': len(self._sessions),
+            'bytes': self.bytes_held(),
+            'expired': self.expired,
+            'evicted': self.evicted
+        }
+
+# User session data
+user_sessions = SessionStore(SESSION_TTL, SESSION_MAX_BYTES, SESSION_SWEEP_INTERVAL)
+
+def with_session(handler):
+    """End the conversation politely when the user's session has expired."""
+    @functools.wraps(handler)
+    def wrapper(update: Update, context: CallbackContext) -> int:
+        if update.message.from_user.id not in user_sessions:
+            update.message.reply_text(
+                "Your session has expired. Send /start to begin again.",
+                reply_markup=ReplyKeyboardRemove()
+            )
+            return ConversationHandler.END
+        return handler(update, context)
+    return wrapper
+
+class TemplateStore:
+    """Decoded template backgrounds, ready to be copied for each render.
+
+    Every template in TEMPLATES is decoded and converted to RGB once by
+    load_all(). get() compares the file's mtime with the one it was loaded
+    from, so a background replaced in TEMPLATES_DIR is picked up without a
+    restart.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._images = {}  # template name -> (mtime, RGB image)
+
+    def _path(self, name):
+        return os.path.join(self.directory, f"{name}.jpg")
+
+    def load_all(self):
+        for name in TEMPLATES.values():
+            self.get(name)
+        for name, size in self.memory_usage().items():
+            logger.info(f"Template {name}: {size / 1024 / 1024:.1f} MB")
+
+    def get(self, name):
+        """Return a copy of the background for ``name``, or None if it has no image."""
+        try:
+            mtime = os.stat(self._path(name)).st_mtime
+        except OSError:
+            with self._lock:
+                self._images.pop(name, None)
+            return None
+        
+        with self._lock:
+            cached = self._images.get(name)
+        if cached is None or cached[0] != mtime:
+            if cached is not None:
+                logger.info(f"Reloading changed template {name}")
+            with Image.open(self._path(name)) as template_img:
+                cached = (mtime, template_img.convert('RGB'))
+            with self._lock:
+                self._images[name] = cached
+        return cached[1].copy()
+
+    def memory_usage(self):
+        """Return the bytes held by each decoded template."""
+        with self._lock:
+            return {
+                name: len(img.getbands()) * img.width * img.height
+                for name, (_, img) in self._images.items()
+            }
+
+template_store = TemplateStore(TEMPLATES_DIR)
+
+class FontStore:
+    """Uploaded custom fonts, kept in memory and keyed by the SHA-256 of the file.
+
+    The same file uploaded by several users is stored and parsed once. Each
+    font keeps the sizes it has been loaded at, and whole fonts are evicted
+    least recently used first once they hold more than ``max_bytes``. Pillow
+    keeps its own copy of the file for every loaded size, so a font counts
+    its file once plus once per size.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._fonts = OrderedDict()  # digest -> (file bytes, {size: font})
+
+    def add(self, font_bytes):
+        """Validate and store a font file, returning its digest.
+        
+        Raises ValueError when the file is too large or isn't a TTF/OTF font.
+        """
+        if len(font_bytes) > MAX_FONT_BYTES:
+            raise ValueError("font file is too large")
+        if font_bytes[:4] not in FONT_SIGNATURES:
+            raise ValueError("not a TrueType or OpenType font")
+        
+        digest = hashlib.sha256(font_bytes).hexdigest()
+        with self._lock:
+            if digest in self._fonts:
+                self._fonts.move_to_end(digest)
+                return digest
+        
+        # Parsing once up front rejects broken files before they reach a render
+        try:
+            font = ImageFont.truetype(BytesIO(font_bytes), FONT_SIZES['title'])
+        except OSError:
+            raise ValueError("the font file could not be read")
+        
+        with self._lock:
+            if digest not in self._fonts:
+                self._fonts[digest] = (font_bytes, {FONT_SIZES['title']: font})
+                self.size += 2 * len(font_bytes)
+                self._evict()
+        return digest
+
+    def _evict(self):
+        # The most recently used font stays even when it alone is over the cap
+        while self.size > self.max_bytes and len(self._fonts) > 1:
+            _, (evicted, sizes) = self._fonts.popitem(last=False)
+            self.size -= len(evicted) * (1 + len(sizes))
+
+    def get(self, digest, size):
+        """Return the font for ``digest`` at ``size``, or None if it was evicted."""
+        with self._lock:
+            entry = self._fonts.get(digest)
+            if entry is None:
+                return None
+            self._fonts.move_to_end(digest)
+            font_bytes, sizes = entry
+            font = sizes.get(size)
+        if font is None:
+            font = ImageFont.truetype(BytesIO(font_bytes), size)
+            with self._lock:
+                if size not in sizes and self._fonts.get(digest) is entry:
+                    sizes[size] = font
+                    self.size += len(font_bytes)
+                    self._evict()
+        return font
+
+font_store = FontStore(FONT_CACHE_BYTES)
 
 def start(update: Update, context: CallbackContext) -> int:
     """Start the conversation and ask for the manga name."""
     user_id = update.message.from_user.id
-    user_sessions[user_id] = {
-        'step': MANGA_NAME,
-        'data': {},
-        'created_at': datetime.now()
-    }
+    user_sessions.new(user_id)
     
     update.message.reply_text(
         "🎌 Welcome to Manga Thumbnail Generator! 🎌\n\n"
@@ -93,6 +323,7 @@ def start(update: Update, context: CallbackContext) -> int:
     )
     return MANGA_NAME
 
+@with_session
 def manga_name(update: Update, context: CallbackContext) -> int:
     """Store the manga name and ask for the manga profile picture."""
     user_id = update.message.from_user.id
@@ -103,6 +334,7 @@ def manga_name(update: Update, context: CallbackContext) -> int:
     )
     return MANGA_PFP
 
+@with_session
 def manga_pfp(update: Update, context: CallbackContext) -> int:
     """Store the manga profile picture and ask for synopsis."""
     user_id = update.message.from_user.id
@@ -118,6 +350,7 @@ def manga_pfp(update: Update, context: CallbackContext) -> int:
     )
     return SYNOPSIS
 
+@with_session
 def synopsis(update: Update, context: CallbackContext) -> int:
     """Store the synopsis and ask for percentage."""
     user_id = update.message.from_user.id
@@ -128,6 +361,7 @@ def synopsis(update: Update, context: CallbackContext) -> int:
     )
     return PERCENTAGE
 
+@with_session
 def percentage(update: Update, context: CallbackContext) -> int:
     """Store the percentage and ask for year."""
     user_id = update.message.from_user.id
@@ -145,6 +379,7 @@ def percentage(update: Update, context: CallbackContext) -> int:
     )
     return YEAR
 
+@with_session
 def year(update: Update, context: CallbackContext) -> int:
     """Store the year and ask for author."""
     user_id = update.message.from_user.id
@@ -160,6 +395,7 @@ def year(update: Update, context: CallbackContext) -> int:
     )
     return AUTHOR
 
+@with_session
 def author(update: Update, context: CallbackContext) -> int:
     """Store the author and ask for template style."""
     user_id = update.message.from_user.id
@@ -174,6 +410,7 @@ def author(update: Update, context: CallbackContext) -> int:
     )
     return TEMPLATE_STYLE
 
+@with_session
 def template_style(update: Update, context: CallbackContext) -> int:
     """Store the template style and ask for color scheme."""
     user_id = update.message.from_user.id
@@ -188,6 +425,7 @@ def template_style(update: Update, context: CallbackContext) -> int:
     )
     return COLOR_SCHEME
 
+@with_session
 def color_scheme(update: Update, context: CallbackContext) -> int:
     """Store the color scheme and ask for text style."""
     user_id = update.message.from_user.id
@@ -215,6 +453,7 @@ def color_scheme(update: Update, context: CallbackContext) -> int:
     )
     return TEXT_STYLE
 
+@with_session
 def custom_color(update: Update, context: CallbackContext) -> int:
     """Handle custom color input."""
     user_id = update.message.from_user.id
@@ -236,6 +475,7 @@ def custom_color(update: Update, context: CallbackContext) -> int:
     )
     return TEXT_STYLE
 
+@with_session
 def text_style(update: Update, context: CallbackContext) -> int:
     """Store the text style and ask for branding."""
     user_id = update.message.from_user.id
@@ -256,22 +496,31 @@ def text_style(update: Update, context: CallbackContext) -> int:
     )
     return BRANDING
 
+@with_session
 def custom_font(update: Update, context: CallbackContext) -> int:
     """Handle custom font upload."""
     user_id = update.message.from_user.id
     
-    if update.message.document:
+    document = update.message.document
+    if document:
+        # Reject oversized files before downloading them
+        if document.file_size and document.file_size > MAX_FONT_BYTES:
+            update.message.reply_text("That font file is too large. Please send a smaller one:")
+            return CUSTOM_FONT
+        
         # Get the font file
-        font_file = update.message.document.get_file()
+        font_file = document.get_file()
         font_data = BytesIO()
         font_file.download(out=font_data)
         
-        # Save the font temporarily
-        font_filename = f"temp_font_{user_id}.ttf"
-        with open(font_filename, 'wb') as f:
-            f.write(font_data.getvalue())
+        # Keep the font in memory, shared with anyone who uploads the same file
+        try:
+            digest = font_store.add(font_data.getvalue())
+        except ValueError as e:
+            update.message.reply_text(f"Sorry, I can't use that font ({e}). Please send a .ttf or .otf file:")
+            return CUSTOM_FONT
         
-        user_sessions[user_id]['data']['text_style'] = font_filename
+        user_sessions[user_id]['data']['text_style'] = digest
         user_sessions[user_id]['data']['custom_font'] = True
     else:
         update.message.reply_text("Please send a font file (ttf or otf format):")
@@ -282,6 +531,7 @@ def custom_font(update: Update, context: CallbackContext) -> int:
     )
     return BRANDING
 
+@with_session
 def branding(update: Update, context: CallbackContext) -> int:
     """Store the branding and show confirmation."""
     user_id = update.message.from_user.id
@@ -297,7 +547,7 @@ def branding(update: Update, context: CallbackContext) -> int:
     Percentage: {user_sessions[user_id]['data']['percentage']}%
     Template: {user_sessions[user_id]['data']['template_style']}
     Color: {user_sessions[user_id]['data']['color_scheme']}
-    Font: {user_sessions[user_id]['data']['text_style']}
+    Font: {"Custom" if user_sessions[user_id]['data'].get('custom_font') else user_sessions[user_id]['data']['text_style']}
     Branding: {user_sessions[user_id]['data']['branding']}
     
     Would you like to generate the thumbnail now? (yes/no)
@@ -306,25 +556,27 @@ def branding(update: Update, context: CallbackContext) -> int:
     update.message.reply_text(summary)
     return CONFIRMATION
 
+@with_session
 def confirmation(update: Update, context: CallbackContext) -> int:
     """Handle confirmation and generate thumbnail."""
     user_id = update.message.from_user.id
     response = update.message.text.lower()
     
+    # The conversation ends here either way, so the session can go
+    data = user_sessions.pop(user_id)['data']
+    
     if response == 'yes':
         update.message.reply_text("Generating your manga thumbnail... Please wait.")
         
         # Generate the thumbnail
         try:
-            thumbnail_path = generate_thumbnail(user_id)
+            thumbnail_path = generate_thumbnail(user_id, data)
             
             # Send the generated image
             with open(thumbnail_path, 'rb') as photo:
                 update.message.reply_photo(photo=photo, caption="Here's your manga thumbnail!")
             
             # Clean up
-            if user_sessions[user_id]['data'].get('custom_font'):
-                os.remove(user_sessions[user_id]['data']['text_style'])
             os.remove(thumbnail_path)
             
         except Exception as e:
@@ -339,23 +591,34 @@ def confirmation(update: Update, context: CallbackContext) -> int:
 
 def cancel(update: Update, context: CallbackContext) -> int:
     """Cancel the conversation."""
-    user_id = update.message.from_user.id
-    if user_id in user_sessions and user_sessions[user_id]['data'].get('custom_font'):
-        os.remove(user_sessions[user_id]['data']['text_style'])
-    
+    user_sessions.pop(update.message.from_user.id, None)
     update.message.reply_text(
         'Thumbnail generation cancelled.', reply_markup=ReplyKeyboardRemove()
     )
     return ConversationHandler.END
 
-def generate_thumbnail(user_id):
+def load_font(data, size):
+    """Return the session's font at ``size``, falling back to the default font."""
+    try:
+        if data.get('custom_font'):
+            font = font_store.get(data['text_style'], size)
+            if font is not None:
+                return font
+            logger.warning("Custom font was evicted before the render, using the default font")
+        else:
+            return ImageFont.truetype(f"fonts/{data['text_style']}", size)
+    except OSError:
+        pass
+    return ImageFont.load_default()
+
+def generate_thumbnail(user_id, data=None):
     """Generate the manga thumbnail based on user preferences."""
-    data = user_sessions[user_id]['data']
+    if data is None:
+        data = user_sessions[user_id]['data']
     
     # Load template background if exists
-    template_path = f"templates/{data['template_style']}.jpg"
-    if os.path.exists(template_path):
-        img = Image.open(template_path).convert('RGB')
+    img = template_store.get(data['template_style'])
+    if img is not None:
         width, height = img.size
     else:
         # Create a blank image with default size
@@ -387,38 +650,20 @@ def generate_thumbnail(user_id):
     img.paste(pfp_img, (width//2 - pfp_size//2, 50), pfp_img)
     
     # Add manga name
-    try:
-        if data.get('custom_font'):
-            font = ImageFont.truetype(data['text_style'], FONT_SIZES['title'])
-        else:
-            font = ImageFont.truetype(f"fonts/{data['text_style']}", FONT_SIZES['title'])
-    except:
-        font = ImageFont.load_default()
+    font = load_font(data, FONT_SIZES['title'])
     
     manga_name = data['manga_name']
     draw.text((width//2, 400), manga_name, fill=primary_color, font=font, anchor="mm")
     
     # Add author and details
-    try:
-        if data.get('custom_font'):
-            details_font = ImageFont.truetype(data['text_style'], FONT_SIZES['details'])
-        else:
-            details_font = ImageFont.truetype(f"fonts/{data['text_style']}", FONT_SIZES['details'])
-    except:
-        details_font = ImageFont.load_default()
+    details_font = load_font(data, FONT_SIZES['details'])
     
     details = f"AUTHOR\n{data['author']}\n\nCHAPTERS\n128+ Chapters\n\nTYPE\nManga\n\nYEAR\n{data['year']}"
     draw.multiline_text((width//2, 480), details, fill='black', font=details_font, anchor="mm", align="center")
     
     # Add percentage
     percentage = data['percentage']
-    try:
-        if data.get('custom_font'):
-            percent_font = ImageFont.truetype(data['text_style'], FONT_SIZES['percentage'])
-        else:
-            percent_font = ImageFont.truetype(f"fonts/{data['text_style']}", FONT_SIZES['percentage'])
-    except:
-        percent_font = ImageFont.load_default()
+    percent_font = load_font(data, FONT_SIZES['percentage'])
     
     draw.text((width//2, 650), f"{percentage}%", fill=primary_color, font=percent_font, anchor="mm")
     
@@ -439,25 +684,13 @@ def generate_thumbnail(user_id):
     synopsis_text = data['synopsis']
     wrapped_text = textwrap.fill(synopsis_text, width=40)
     
-    try:
-        if data.get('custom_font'):
-            synopsis_font = ImageFont.truetype(data['text_style'], FONT_SIZES['synopsis'])
-        else:
-            synopsis_font = ImageFont.truetype(f"fonts/{data['text_style']}", FONT_SIZES['synopsis'])
-    except:
-        synopsis_font = ImageFont.load_default()
+    synopsis_font = load_font(data, FONT_SIZES['synopsis'])
     
     draw.multiline_text((width//2, 750), wrapped_text, fill='black', font=synopsis_font, anchor="mm", align="center")
     
     # Add branding
     branding_text = data['branding']
-    try:
-        if data.get('custom_font'):
-            branding_font = ImageFont.truetype(data['text_style'], FONT_SIZES['branding'])
-        else:
-            branding_font = ImageFont.truetype(f"fonts/{data['text_style']}", FONT_SIZES['branding'])
-    except:
-        branding_font = ImageFont.load_default()
+    branding_font = load_font(data, FONT_SIZES['branding'])
     
     # Position branding in top right
     bbox = draw.textbbox((0, 0), branding_text, font=branding_font)
@@ -483,6 +716,9 @@ def main() -> None:
         logger.error("No BOT_TOKEN environment variable found!")
         return
     
+    # Decode the template backgrounds once up front
+    template_store.load_all()
+    
     # Create the Updater and pass it your bot's token
     updater = Updater(token)
 
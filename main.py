@@ -1,14 +1,38 @@
 import os
 import logging
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+import asyncio
+import threading
+import hashlib
+import json
+import time
+import functools
+import sqlite3
+import queue
+import contextlib
+import multiprocessing
+import multiprocessing.connection
+import csv
+import sys
+import zipfile
+import argparse
+import collections
+import http.server
+from collections import OrderedDict
+import concurrent.futures
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+import httpx
+from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InputMediaPhoto
+from telegram.error import BadRequest, TelegramError
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
+    Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler,
+    BasePersistence, PersistenceInput, BaseUpdateProcessor
 )
-from PIL import Image, ImageDraw, ImageFont, ImageOps, ImageEnhance
-import textwrap
-from io import BytesIO
+from PIL import Image, ImageDraw, ImageFont, ImageEnhance, ImageFilter, ImageChops, ImageColor
+from io import BytesIO, StringIO
 import random
 import re
+import string
 
 # Enable logging
 logging.basicConfig(
@@ -20,16 +44,17 @@ logger = logging.getLogger(__name__)
 (
     MANGA_NAME, MANGA_PFP, SYNOPSIS, PERCENTAGE, YEAR, AUTHOR, 
     TEMPLATE_STYLE, COLOR_SCHEME, TEXT_STYLE, BRANDING, CONFIRMATION,
-    CUSTOM_COLOR
-) = range(12)
-
-# Available templates
-TEMPLATES = {
-    "Style 1 - Default": "default",
-    "Style 2 - Minimal": "minimal", 
-    "Style 3 - Elegant": "elegant",
-    "Style 4 - Modern": "modern"
-}
+    CUSTOM_COLOR, BATCH_MANIFEST
+) = range(13)
+
+# Template specs, one <style>.json per template
+TEMPLATES_DIR = os.getenv('TEMPLATES_DIR', 'templates')
+
+# Available templates, menu label -> style; filled from the specs in TEMPLATES_DIR
+TEMPLATES = {}
+
+# Session fields a template's text may use as {placeholders}
+TEMPLATE_FIELDS = ('manga_name', 'synopsis', 'percentage', 'year', 'author', 'branding')
 
 # Available colors
 COLORS = {
@@ -45,6 +70,7 @@ COLORS = {
     "Gold": "#FFD700",
     "Silver": "#C0C0C0",
     "Random": "random",
+    "Auto": "auto",
     "Custom": "custom"
 }
 
@@ -57,23 +83,1705 @@ FONTS = {
     "Modern": "modern.ttf"
 }
 
-# Font sizes for different elements
-FONT_SIZES = {
-    "title": 40,
-    "author": 20,
-    "details": 18,
-    "percentage": 36,
-    "synopsis": 16,
-    "branding": 20
+# Limits for uploaded cover images, checked before they are decoded
+MAX_COVER_BYTES = int(os.getenv('MAX_COVER_BYTES', 10 * 1024 * 1024))
+MAX_COVER_PIXELS = int(os.getenv('MAX_COVER_PIXELS', 25_000_000))
+
+# "Auto" colors: the cover is reduced to AUTO_COLOR_SAMPLE pixels square and
+# quantized to AUTO_COLOR_PALETTE colors; the pick must reach the WCAG
+# contrast ratio AUTO_COLOR_MIN_CONTRAST against the template background.
+AUTO_COLOR_SAMPLE = 64
+AUTO_COLOR_PALETTE = 8
+AUTO_COLOR_MIN_CONTRAST = float(os.getenv('AUTO_COLOR_MIN_CONTRAST', 3.0))
+COVER_PALETTE_CACHE_SIZE = int(os.getenv('COVER_PALETTE_CACHE_SIZE', 1024))
+
+# Avatar diameter used by each template, filled when the templates load. The
+# cover is downloaded before the template is picked, so the largest of these
+# decides the photo size fetched.
+TEMPLATE_AVATAR_SIZES = {}
+
+# Max number of pre-drawn static layers kept in memory (about 2.4MB each)
+STATIC_LAYER_CACHE_SIZE = int(os.getenv('STATIC_LAYER_CACHE_SIZE', 16))
+
+# Output formats for rendered thumbnails and their file extensions
+OUTPUT_FORMATS = {
+    "JPEG": "jpg",
+    "WEBP": "webp",
+    "PNG": "png"
+}
+
+# Encoder settings for each output format, from quickest to smallest output.
+# JPEG chroma subsampling is explicit: 4:2:0 is smaller and faster, 4:4:4
+# keeps the edges of thin colored text sharp.
+ENCODER_PRESETS = {
+    "fast": {
+        "JPEG": {"optimize": False, "progressive": False, "subsampling": "4:2:0"},
+        "WEBP": {"method": 0},
+        "PNG": {"compress_level": 1}
+    },
+    "balanced": {
+        "JPEG": {"optimize": True, "progressive": False, "subsampling": "4:4:4"},
+        "WEBP": {"method": 4},
+        "PNG": {"compress_level": 6}
+    },
+    "smallest": {
+        "JPEG": {"optimize": True, "progressive": True, "subsampling": "4:2:0"},
+        "WEBP": {"method": 6},
+        "PNG": {"optimize": True}
+    }
 }
 
-# User session data
-user_sessions = {}
+# Encoding used for thumbnails sent to users
+THUMBNAIL_FORMAT = os.getenv('THUMBNAIL_FORMAT', 'JPEG').upper()
+THUMBNAIL_QUALITY = int(os.getenv('THUMBNAIL_QUALITY', 75))
+THUMBNAIL_PRESET = os.getenv('THUMBNAIL_PRESET', 'balanced')
+
+# Byte budget per encoded image (0 for none); quality is lowered until the
+# image fits, but not below THUMBNAIL_MIN_QUALITY
+THUMBNAIL_MAX_BYTES = int(os.getenv('THUMBNAIL_MAX_BYTES', 0))
+THUMBNAIL_MIN_QUALITY = int(os.getenv('THUMBNAIL_MIN_QUALITY', 40))
+
+# Smaller copies rendered next to the full-size thumbnail, as comma separated
+# name=WIDTHxHEIGHT:FORMAT[:QUALITY], e.g. "grid=400x500:WEBP,card=200x250:WEBP"
+OUTPUT_PROFILES_SPEC = os.getenv('OUTPUT_PROFILES', '')
+
+# Session fields that determine what a rendered thumbnail looks like
+THUMBNAIL_FIELDS = (
+    'manga_name', 'synopsis', 'percentage', 'year', 'author',
+    'template_style', 'color_scheme', 'text_style', 'branding'
+)
+
+# Part of every thumbnail digest; bump it whenever a change to the drawing
+# code alters the pixels, so cached thumbnails from older code are not reused
+RENDER_VERSION = 3
+
+# Rendered thumbnail cache settings (RENDER_CACHE_DIR enables the on-disk store)
+RENDER_CACHE_BYTES = int(os.getenv('RENDER_CACHE_BYTES', 64 * 1024 * 1024))
+RENDER_CACHE_DIR = os.getenv('RENDER_CACHE_DIR')
+RENDER_CACHE_DISK_BYTES = int(os.getenv('RENDER_CACHE_DISK_BYTES', 1024 * 1024 * 1024))
+
+# Render timing metrics (RENDER_METRICS=0 turns the stage timers off)
+RENDER_METRICS = os.getenv('RENDER_METRICS', '1') != '0'
+METRICS_WINDOW = int(os.getenv('METRICS_WINDOW', 1000))
+
+# Prometheus endpoint; defaults to the port after the webhook's, METRICS_PORT=0 turns it off
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = os.getenv('METRICS_PORT')
+
+# Histogram buckets in seconds
+RENDER_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float('inf'))
+API_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+CONVERSATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, float('inf'))
+
+# Lookup tables mapping gray levels to a sepia tone, one per RGB channel
+SEPIA_LUTS = [
+    [min(255, int(level * factor)) for level in range(256)]
+    for factor in (1.07, 0.87, 0.66)
+]
+
+# Max number of cached glow masks
+GLOW_CACHE_SIZE = int(os.getenv('GLOW_CACHE_SIZE', 256))
+
+# Pixels between lines of wrapped text
+LINE_SPACING = 4
+
+# Max number of memoized text measurements and fitted layouts
+TEXT_MEASURE_CACHE_SIZE = int(os.getenv('TEXT_MEASURE_CACHE_SIZE', 16384))
+TEXT_LAYOUT_CACHE_SIZE = int(os.getenv('TEXT_LAYOUT_CACHE_SIZE', 1024))
+
+# Max number of (font, size) entries kept for fonts outside FONTS
+FONT_CACHE_SIZE = int(os.getenv('FONT_CACHE_SIZE', 64))
+
+# Render worker pool settings
+RENDER_EXECUTOR = os.getenv('RENDER_EXECUTOR', 'thread')  # "thread", "process" or "farm"
+# How render processes are started; not "fork", they start while this process runs threads
+RENDER_START_METHOD = os.getenv('RENDER_START_METHOD', 'forkserver')
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', min(4, os.cpu_count() or 1)))
+RENDER_QUEUE_SIZE = int(os.getenv('RENDER_QUEUE_SIZE', 32))
+RENDER_TIMEOUT = float(os.getenv('RENDER_TIMEOUT', 60))
+
+# Admission control in front of renders: token buckets per user and per chat
+# (a rate of 0 turns a bucket off), and a budget of jobs in flight that
+# defaults to what the render pool can run and queue. A job that would wait
+# longer than RATE_LIMIT_MAX_DELAY seconds for a token is dropped.
+RATE_LIMIT_USER_PER_MINUTE = float(os.getenv('RATE_LIMIT_USER_PER_MINUTE', 6))
+RATE_LIMIT_USER_BURST = int(os.getenv('RATE_LIMIT_USER_BURST', 3))
+RATE_LIMIT_CHAT_PER_MINUTE = float(os.getenv('RATE_LIMIT_CHAT_PER_MINUTE', 30))
+RATE_LIMIT_CHAT_BURST = int(os.getenv('RATE_LIMIT_CHAT_BURST', 10))
+RATE_LIMIT_MAX_DELAY = float(os.getenv('RATE_LIMIT_MAX_DELAY', 5))
+ADMISSION_BUDGET = int(os.getenv('ADMISSION_BUDGET', 0))
+
+# Webhook server settings. Up to CONCURRENT_UPDATES updates are handled at
+# once (1 handles them one by one), updates from the same user in the same
+# chat always run in order.
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', 64))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+
+# Bot API connection pools: uploads and file downloads get their own pool so
+# a slow photo upload can't hold up short calls like sendMessage
+API_POOL_SIZE = int(os.getenv('API_POOL_SIZE', 32))
+MEDIA_POOL_SIZE = int(os.getenv('MEDIA_POOL_SIZE', 8))
+API_POOL_TIMEOUT = float(os.getenv('API_POOL_TIMEOUT', 5))
+MEDIA_POOL_TIMEOUT = float(os.getenv('MEDIA_POOL_TIMEOUT', 30))
+MEDIA_WRITE_TIMEOUT = float(os.getenv('MEDIA_WRITE_TIMEOUT', 20))
+
+# Telegram user ids allowed to use admin commands such as /batch
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
+
+# Batch renders in progress, user_id -> stop events of its running batches
+batch_jobs = {}
+
+# Batch rendering limits
+BATCH_MAX_ROWS = int(os.getenv('BATCH_MAX_ROWS', 100))
+BATCH_MAX_MANIFEST_BYTES = int(os.getenv('BATCH_MAX_MANIFEST_BYTES', 1024 * 1024))
+BATCH_PROGRESS_INTERVAL = float(os.getenv('BATCH_PROGRESS_INTERVAL', 3))
+
+# Session expiry settings
+SESSION_TTL = float(os.getenv('SESSION_TTL', 3600))
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_BYTES', 64 * 1024 * 1024))
+SESSION_SWEEP_INTERVAL = float(os.getenv('SESSION_SWEEP_INTERVAL', 30))
+
+# Session backend: "memory" or "sqlite". SQLite sessions are shared by all
+# processes using SESSION_DB_PATH, but PTB reads the persisted conversation
+# states only at startup, so each process must keep getting the same users'
+# updates; across restarts both sessions and conversation states survive.
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'memory')
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', 'sessions.db')
+SESSION_FLUSH_INTERVAL = float(os.getenv('SESSION_FLUSH_INTERVAL', 1))
+SESSION_BATCH_SIZE = int(os.getenv('SESSION_BATCH_SIZE', 50))
+
+class SessionStore:
+    """Interface of the session backends.
+
+    A session is a dict with 'data' (the user's answers so far), 'created_at'
+    and 'last_activity'. Handlers change answers through set(), since a session
+    returned by a persistent backend is only a snapshot. Every method is a
+    coroutine so a backend can do its I/O off the event loop.
+    """
+
+    async def new(self, user_id):
+        """Start a fresh session for a user and return it."""
+        raise NotImplementedError
+
+    async def exists(self, user_id):
+        raise NotImplementedError
+
+    async def get(self, user_id):
+        """Return the session of a user and mark it as active; KeyError if there is none."""
+        raise NotImplementedError
+
+    async def set(self, user_id, key, value):
+        """Store one answer in a user's session."""
+        raise NotImplementedError
+
+    async def pop(self, user_id, default=None):
+        raise NotImplementedError
+
+    async def sweep(self):
+        """Drop expired sessions and enforce the memory cap."""
+        raise NotImplementedError
+
+    async def stats(self):
+        raise NotImplementedError
+
+    async def flush(self):
+        """Write out buffered changes. Backends that don't buffer do nothing."""
+
+    @staticmethod
+    def session_size(session):
+        """Approximate bytes held by a session's text and image data."""
+        return sum(len(value) for value in session['data'].values() if isinstance(value, (bytes, str)))
+
+class MemorySessionStore(SessionStore):
+    """In-memory user sessions with idle expiry and a memory cap.
+
+    Sessions are kept in order of last activity. A sweep drops sessions idle
+    for longer than ``ttl`` and then the least recently active ones until the
+    bytes held fall under ``max_bytes``. Sweeps run on every new session and
+    at most every ``sweep_interval`` seconds on lookups.
+    """
+
+    def __init__(self, ttl, max_bytes, sweep_interval):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.expired = 0
+        self.evicted = 0
+        self._sessions = OrderedDict()
+        self._last_sweep = time.time()
+
+    async def new(self, user_id):
+        now = time.time()
+        session = {'data': {}, 'created_at': now, 'last_activity': now}
+        self._sessions.pop(user_id, None)
+        self._sessions[user_id] = session
+        await self.sweep()
+        return session
+
+    async def exists(self, user_id):
+        return user_id in self._sessions
+
+    async def get(self, user_id):
+        session = self._sessions[user_id]
+        session['last_activity'] = time.time()
+        self._sessions.move_to_end(user_id)
+        if session['last_activity'] - self._last_sweep > self.sweep_interval:
+            await self.sweep()
+        return session
+
+    def __len__(self):
+        return len(self._sessions)
+
+    async def set(self, user_id, key, value):
+        (await self.get(user_id))['data'][key] = value
+
+    async def pop(self, user_id, default=None):
+        return self._sessions.pop(user_id, default)
+
+    def bytes_held(self):
+        return sum(self.session_size(session) for session in self._sessions.values())
+
+    async def sweep(self):
+        """Drop idle sessions, then the oldest ones while over the memory cap."""
+        now = time.time()
+        self._last_sweep = now
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if now - session['last_activity'] <= self.ttl:
+                break
+            del self._sessions[user_id]
+            self.expired += 1
+        
+        held = self.bytes_held()
+        # Never evict the session that is currently active
+        while held > self.max_bytes and len(self._sessions) > 1:
+            _, session = self._sessions.popitem(last=False)
+            held -= self.session_size(session)
+            self.evicted += 1
+
+    async def stats(self):
+        return {
+            'sessions': len(self._sessions),
+            'bytes': self.bytes_held(),
+            'expired': self.expired,
+            'evicted': self.evicted
+        }
+
+class SQLiteDatabase:
+    """A single connection to an SQLite database, used from worker threads.
+
+    SQLite runs one write transaction at a time anyway, so a pool of
+    connections gains nothing here; queries run through run() so waiting on
+    the database lock never blocks the event loop.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # WAL lets several bot processes read while one of them writes
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Use the connection; the block runs as one transaction."""
+        with self._lock:
+            with self._conn:
+                yield self._conn
+
+    async def run(self, func, *args):
+        """Run ``func(conn, *args)`` as one transaction on a worker thread."""
+        def transaction():
+            with self.connection() as conn:
+                return func(conn, *args)
+        return await asyncio.to_thread(transaction)
+
+class SQLiteSessionStore(SessionStore):
+    """User sessions kept in SQLite, shared by every bot process using the file.
+
+    Each answer is its own row in session_fields: text as JSON, bytes such as
+    the avatar as a BLOB, so sweeps and size checks never decode them. Writes
+    touch only what changed, the answers a process set and the activity time
+    it saw, so processes answering for the same user don't overwrite each
+    other's fields with stale copies. Changes are buffered and committed in
+    one transaction once ``batch_size`` sessions are dirty or
+    ``flush_interval`` seconds have passed; reads in this process see its own
+    buffered changes. Queries run on a worker thread and one at a time, so a
+    read never misses a flush that is still being written.
+    """
+
+    def __init__(self, db, ttl, max_bytes, sweep_interval, flush_interval, batch_size):
+        self.db = db
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.expired = 0
+        self.evicted = 0
+        self._new = {}  # user_id -> (created_at, last_activity) of sessions started here
+        self._fields = {}  # user_id -> {key: value} set but not yet written
+        self._touched = {}  # user_id -> latest activity seen here
+        self._deleted = set()
+        self._lock = asyncio.Lock()
+        self._last_sweep = time.time()
+        self._last_flush = time.time()
+        with self.db.connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS user_sessions ('
+                'user_id INTEGER PRIMARY KEY, created_at REAL NOT NULL, last_activity REAL NOT NULL)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS session_fields ('
+                'user_id INTEGER NOT NULL, key TEXT NOT NULL, value NOT NULL, '
+                'PRIMARY KEY (user_id, key))'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS user_sessions_activity ON user_sessions (last_activity)')
+
+    @staticmethod
+    def _read(conn, user_id):
+        row = conn.execute(
+            'SELECT created_at, last_activity FROM user_sessions WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        data = {
+            key: bytes(value) if isinstance(value, bytes) else json.loads(value)
+            for key, value in conn.execute(
+                'SELECT key, value FROM session_fields WHERE user_id = ?', (user_id,)
+            )
+        }
+        return {'data': data, 'created_at': row[0], 'last_activity': row[1]}
+
+    async def _load(self, user_id):
+        if user_id in self._deleted:
+            return None
+        if user_id in self._new:
+            created_at, last_activity = self._new[user_id]
+            session = {'data': {}, 'created_at': created_at, 'last_activity': last_activity}
+        else:
+            async with self._lock:
+                session = await self.db.run(self._read, user_id)
+            # Changes made while the query ran are merged below as well
+            if session is None or user_id in self._deleted:
+                return None
+        session['data'].update(self._fields.get(user_id, {}))
+        session['last_activity'] = max(session['last_activity'], self._touched.get(user_id, 0))
+        return session
+
+    def _dirty(self):
+        return len(self._new.keys() | self._fields.keys() | self._touched.keys() | self._deleted)
+
+    async def _changed(self):
+        if self._dirty() >= self.batch_size or time.time() - self._last_flush >= self.flush_interval:
+            await self.flush()
+
+    def _forget(self, user_id):
+        self._new.pop(user_id, None)
+        self._fields.pop(user_id, None)
+        self._touched.pop(user_id, None)
+
+    async def new(self, user_id):
+        now = time.time()
+        self._forget(user_id)
+        self._deleted.discard(user_id)
+        self._new[user_id] = (now, now)
+        await self._changed()
+        if now - self._last_sweep > self.sweep_interval:
+            await self.sweep()
+        return {'data': {}, 'created_at': now, 'last_activity': now}
+
+    async def exists(self, user_id):
+        if user_id in self._new:
+            return True
+        if user_id in self._deleted:
+            return False
+        async with self._lock:
+            found = await self.db.run(
+                lambda conn: conn.execute('SELECT 1 FROM user_sessions WHERE user_id = ?', (user_id,)).fetchone()
+            )
+        return found is not None and user_id not in self._deleted
+
+    async def get(self, user_id):
+        session = await self._load(user_id)
+        if session is None:
+            raise KeyError(user_id)
+        session['last_activity'] = self._touched[user_id] = time.time()
+        await self._changed()
+        if session['last_activity'] - self._last_sweep > self.sweep_interval:
+            await self.sweep()
+        return session
+
+    async def set(self, user_id, key, value):
+        if not await self.exists(user_id):
+            raise KeyError(user_id)
+        self._fields.setdefault(user_id, {})[key] = value
+        self._touched[user_id] = time.time()
+        await self._changed()
+
+    async def pop(self, user_id, default=None):
+        session = await self._load(user_id)
+        self._forget(user_id)
+        self._deleted.add(user_id)
+        return default if session is None else session
+
+    @staticmethod
+    def _write(conn, new, fields, touched, deleted):
+        for user_id in deleted:
+            conn.execute('DELETE FROM user_sessions WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM session_fields WHERE user_id = ?', (user_id,))
+        for user_id, (created_at, last_activity) in new.items():
+            conn.execute('DELETE FROM session_fields WHERE user_id = ?', (user_id,))
+            conn.execute(
+                'INSERT OR REPLACE INTO user_sessions VALUES (?, ?, ?)', (user_id, created_at, last_activity)
+            )
+        conn.executemany(
+            'UPDATE user_sessions SET last_activity = MAX(last_activity, ?) WHERE user_id = ?',
+            [(last_activity, user_id) for user_id, last_activity in touched.items()]
+        )
+        # Fields of a session another process ended in the meantime are dropped
+        conn.executemany(
+            'INSERT OR REPLACE INTO session_fields SELECT ?, ?, ? '
+            'WHERE EXISTS (SELECT 1 FROM user_sessions WHERE user_id = ?)',
+            [
+                (user_id, key, value if isinstance(value, bytes) else json.dumps(value), user_id)
+                for user_id, user_fields in fields.items() for key, value in user_fields.items()
+            ]
+        )
+
+    async def flush(self):
+        """Commit all buffered changes in a single transaction."""
+        async with self._lock:
+            self._last_flush = time.time()
+            if not self._dirty():
+                return
+            # Changes made while this batch is written go into fresh buffers
+            batch = self._new, self._fields, self._touched, self._deleted
+            self._new, self._fields, self._touched, self._deleted = {}, {}, {}, set()
+            try:
+                await self.db.run(self._write, *batch)
+            except BaseException:
+                self._requeue(*batch)
+                raise
+
+    def _requeue(self, new, fields, touched, deleted):
+        # Put back a batch that failed to commit. A session started or ended
+        # since then replaces whatever the batch held for it.
+        later = self._new.keys() | self._deleted
+        self._deleted.update(deleted - later)
+        for user_id, times in new.items():
+            if user_id not in later:
+                self._new[user_id] = times
+        for user_id, user_fields in fields.items():
+            if user_id not in later:
+                self._fields[user_id] = {**user_fields, **self._fields.get(user_id, {})}
+        for user_id, last_activity in touched.items():
+            if user_id not in later:
+                self._touched[user_id] = max(last_activity, self._touched.get(user_id, 0))
+
+    @staticmethod
+    def _sizes(conn):
+        """Return (user_id, bytes) for every session, least recently active first."""
+        return conn.execute(
+            'SELECT s.user_id, COALESCE(SUM(length(f.value)), 0) '
+            'FROM user_sessions s LEFT JOIN session_fields f ON f.user_id = s.user_id '
+            'GROUP BY s.user_id ORDER BY s.last_activity'
+        ).fetchall()
+
+    def _expire(self, conn, cutoff):
+        conn.execute(
+            'DELETE FROM session_fields WHERE user_id IN '
+            '(SELECT user_id FROM user_sessions WHERE last_activity < ?)', (cutoff,)
+        )
+        self.expired += conn.execute('DELETE FROM user_sessions WHERE last_activity < ?', (cutoff,)).rowcount
+        
+        sizes = self._sizes(conn)
+        held = sum(size for _, size in sizes)
+        # Never evict the session that is currently active
+        for user_id, size in sizes[:-1]:
+            if held <= self.max_bytes:
+                break
+            conn.execute('DELETE FROM user_sessions WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM session_fields WHERE user_id = ?', (user_id,))
+            held -= size
+            self.evicted += 1
+
+    async def sweep(self):
+        """Drop idle sessions, then the oldest ones while over the memory cap."""
+        await self.flush()
+        now = time.time()
+        self._last_sweep = now
+        async with self._lock:
+            await self.db.run(self._expire, now - self.ttl)
+
+    async def stats(self):
+        await self.flush()
+        async with self._lock:
+            sizes = await self.db.run(self._sizes)
+        return {
+            'sessions': len(sizes),
+            'bytes': sum(size for _, size in sizes),
+            'expired': self.expired,
+            'evicted': self.evicted
+        }
+
+class SQLitePersistence(BasePersistence):
+    """Keeps ConversationHandler states in the session database across restarts.
+
+    Only conversations are stored; the bot doesn't use user, chat or bot data.
+    PTB loads them once when the application starts, so a state written by
+    another running process is not seen until this one restarts.
+    """
+
+    def __init__(self, db, update_interval):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.db = db
+        with self.db.connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS conversations ('
+                'name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, '
+                'PRIMARY KEY (name, key))'
+            )
+
+    async def get_conversations(self, name):
+        rows = await self.db.run(
+            lambda conn: conn.execute('SELECT key, state FROM conversations WHERE name = ?', (name,)).fetchall()
+        )
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            await self.db.run(
+                lambda conn: conn.execute(
+                    'DELETE FROM conversations WHERE name = ? AND key = ?', (name, json.dumps(key))
+                )
+            )
+        else:
+            await self.db.run(
+                lambda conn: conn.execute(
+                    'INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)',
+                    (name, json.dumps(key), json.dumps(new_state))
+                )
+            )
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        await user_sessions.flush()
+
+if SESSION_BACKEND == 'sqlite':
+    session_db = SQLiteDatabase(SESSION_DB_PATH)
+    user_sessions = SQLiteSessionStore(
+        session_db, SESSION_TTL, SESSION_MAX_BYTES, SESSION_SWEEP_INTERVAL,
+        SESSION_FLUSH_INTERVAL, SESSION_BATCH_SIZE
+    )
+else:
+    session_db = None
+    user_sessions = MemorySessionStore(SESSION_TTL, SESSION_MAX_BYTES, SESSION_SWEEP_INTERVAL)
+
+def with_session(handler):
+    """End the conversation politely when the user's session has expired."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        if not await user_sessions.exists(update.message.from_user.id):
+            await update.message.reply_text(
+                "Your session has expired. Send /start to begin again.",
+                reply_markup=ReplyKeyboardRemove()
+            )
+            return ConversationHandler.END
+        return await handler(update, context)
+    return wrapper
+
+class RenderQueueFull(Exception):
+    """Raised when every render worker is busy and the wait queue is full."""
+
+class RenderCancelled(Exception):
+    """Raised when a user cancels a render that is queued or running."""
+
+class AdmissionRejected(Exception):
+    """Raised when admission control drops a job; ``reason`` is "user", "chat" or "busy"."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class StageTimer:
+    """Accumulates the time spent in each named stage of one render."""
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+class NullTimer:
+    """Stand-in used when no render is being timed; stage() does nothing."""
+
+    _context = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self._context
+
+NULL_TIMER = NullTimer()
+
+# Timer of the render running on the current thread, set by timed_render()
+_render_timers = threading.local()
+
+def current_timer():
+    return getattr(_render_timers, 'timer', None) or NULL_TIMER
+
+def timed_render(func, *args):
+    """Run a render function with stage timing on; returns (result, stage ms, total ms)."""
+    timer = StageTimer()
+    _render_timers.timer = timer
+    start = time.perf_counter()
+    try:
+        result = func(*args)
+    finally:
+        _render_timers.timer = None
+    return result, timer.stages, (time.perf_counter() - start) * 1000
+
+class MetricsRegistry:
+    """Counters, histograms and gauges exported in the Prometheus text format.
+
+    Series are updated from the event loop and read by the metrics server
+    thread, so every access goes through one lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}  # name -> (type, help, buckets or gauge function)
+        self._series = {}  # name -> {labels: value, or [bucket counts, sum, count] for histograms}
+
+    def counter(self, name, help_text):
+        self._meta[name] = ('counter', help_text, None)
+        self._series[name] = {}
+
+    def histogram(self, name, help_text, buckets):
+        self._meta[name] = ('histogram', help_text, buckets)
+        self._series[name] = {}
+
+    def gauge(self, name, help_text, func):
+        """Register a gauge whose value is read from ``func()`` at scrape time."""
+        self._meta[name] = ('gauge', help_text, func)
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series[name]
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = self._meta[name][2]
+        with self._lock:
+            histogram = self._series[name].get(key)
+            if histogram is None:
+                histogram = self._series[name][key] = [[0] * len(buckets), 0.0, 0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def totals(self, name, label=None):
+        """Sum a counter, or count a histogram's samples, grouped by one label."""
+        totals = collections.Counter()
+        with self._lock:
+            for key, value in self._series[name].items():
+                group = dict(key).get(label) if label else None
+                totals[group] += value[2] if isinstance(value, list) else value
+        return totals
+
+    @staticmethod
+    def _labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, extra) in self._meta.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == 'gauge':
+                    lines.append(f"{name} {extra()}")
+                    continue
+                for key, value in sorted(self._series[name].items()):
+                    if kind == 'counter':
+                        lines.append(f"{name}{self._labels(key)} {value}")
+                        continue
+                    counts, total, count = value
+                    cumulative = 0
+                    for bound, bucket_count in zip(extra, counts):
+                        cumulative += bucket_count
+                        le = "+Inf" if bound == float('inf') else repr(bound)
+                        lines.append(f"{name}_bucket{self._labels(key, [('le', le)])} {cumulative}")
+                    lines.append(f"{name}_sum{self._labels(key)} {total}")
+                    lines.append(f"{name}_count{self._labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metrics.counter('renders_total', "Thumbnails rendered, by template and font.")
+metrics.counter('render_failures_total', "Renders that raised an error.")
+metrics.histogram('render_stage_seconds', "Time spent in each render stage.", RENDER_BUCKETS)
+metrics.histogram('render_queue_wait_seconds', "Time renders waited for a free worker.", RENDER_BUCKETS)
+metrics.histogram('handler_seconds', "Time spent handling one update, by conversation state.", API_BUCKETS)
+metrics.histogram('state_dwell_seconds', "Time users took to answer each conversation state.", CONVERSATION_BUCKETS)
+metrics.histogram('conversation_seconds', "Time from /start to the thumbnail being delivered.", CONVERSATION_BUCKETS)
+metrics.histogram('telegram_api_seconds', "Latency of Telegram Bot API calls, by method.", API_BUCKETS)
+metrics.counter('telegram_api_errors_total', "Telegram Bot API calls that failed, by method.")
+
+class RenderMetrics:
+    """Render timing metrics for this process.
+
+    Stage timings go to the ``render_stage_seconds`` histogram, labelled by
+    stage, template and font, with 'total' as its own stage. The last
+    ``window`` timings of each stage are also kept for rolling percentiles.
+    """
+
+    def __init__(self, window, registry):
+        self.window = window
+        self.registry = registry
+        self._recent = {}  # stage -> deque of ms
+
+    @property
+    def renders(self):
+        return sum(self.registry.totals('renders_total').values())
+
+    @property
+    def failures(self):
+        return sum(self.registry.totals('render_failures_total').values())
+
+    def record(self, data, stages, total):
+        template, font = data.get('template_style'), data.get('text_style')
+        self.registry.inc('renders_total', template=template, font=font)
+        for stage, elapsed in list(stages.items()) + [('total', total)]:
+            self.registry.observe('render_stage_seconds', elapsed / 1000, stage=stage, template=template, font=font)
+            recent = self._recent.get(stage)
+            if recent is None:
+                recent = self._recent[stage] = collections.deque(maxlen=self.window)
+            recent.append(elapsed)
+        
+        logger.info("render " + json.dumps({
+            'template': template,
+            'font': font,
+            'total_ms': round(total, 2),
+            'stages_ms': {stage: round(elapsed, 2) for stage, elapsed in stages.items()},
+        }))
+
+    def record_failure(self):
+        self.registry.inc('render_failures_total')
+
+    def percentiles(self):
+        """Return {stage: (p50, p95, p99, samples)} over the rolling window."""
+        result = {}
+        for stage, recent in self._recent.items():
+            ordered = sorted(recent)
+            pick = lambda p: ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+            result[stage] = (pick(0.50), pick(0.95), pick(0.99), len(ordered))
+        return result
+
+    def counts(self, label):
+        """Return render counts by 'template' or 'font'."""
+        return self.registry.totals('renders_total', label)
+
+class BotRequest(BaseRequest):
+    """Bot API transport with separate connection pools and per-call latency metrics.
+
+    Calls that upload files, and file downloads, go through the media pool;
+    everything else goes through the API pool.
+    """
+
+    def __init__(self, api_pool_size=API_POOL_SIZE, media_pool_size=MEDIA_POOL_SIZE):
+        self.api = HTTPXRequest(connection_pool_size=api_pool_size, pool_timeout=API_POOL_TIMEOUT)
+        self.media = HTTPXRequest(
+            connection_pool_size=media_pool_size, pool_timeout=MEDIA_POOL_TIMEOUT,
+            write_timeout=MEDIA_WRITE_TIMEOUT
+        )
+
+    @property
+    def read_timeout(self):
+        return self.api.read_timeout
+
+    async def initialize(self):
+        await asyncio.gather(self.api.initialize(), self.media.initialize())
+
+    async def shutdown(self):
+        await asyncio.gather(self.api.shutdown(), self.media.shutdown())
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        if (request_data is not None and request_data.contains_files) or '/file/bot' in url:
+            return await self.media.do_request(url, method, request_data, **timeouts)
+        return await self.api.do_request(url, method, request_data, **timeouts)
+
+    async def post(self, url, *args, **kwargs):
+        return await self._timed(url.rsplit('/', 1)[-1], super().post(url, *args, **kwargs))
+
+    async def retrieve(self, url, *args, **kwargs):
+        return await self._timed('downloadFile', super().retrieve(url, *args, **kwargs))
+
+    @staticmethod
+    async def _timed(method, call):
+        start = time.perf_counter()
+        try:
+            return await call
+        except Exception:
+            metrics.inc('telegram_api_errors_total', method=method)
+            raise
+        finally:
+            metrics.observe('telegram_api_seconds', time.perf_counter() - start, method=method)
+
+def timed_handler(handler):
+    """Record how long a handler takes and how long the user took to reach it.
+
+    Series are labelled with the handler's name, which matches its state.
+    """
+    state = handler.__name__
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        start = time.perf_counter()
+        entered = context.user_data.pop('state_entered_at', None)
+        if entered is not None:
+            metrics.observe('state_dwell_seconds', start - entered, state=state)
+        try:
+            result = await handler(update, context)
+        finally:
+            metrics.observe('handler_seconds', time.perf_counter() - start, state=state)
+        if result is not None and result != ConversationHandler.END:
+            context.user_data['state_entered_at'] = time.perf_counter()
+        return result
+    return wrapper
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Handle updates concurrently, but one at a time per user and chat.
+
+    ConversationHandler keys conversations by (chat, user), so updates with
+    the same key wait for each other and reach it in the order they arrived.
+    Only the oldest update of each key competes for one of the
+    ``max_concurrent_updates`` slots, so a user with a backlog holds a
+    single slot and other chats keep moving. Updates without a user or chat
+    just wait for a slot.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        # PTB holds its own semaphore around do_process_update, where waiting
+        # for a user's lock would tie up a slot, so give it a limit that never binds
+        super().__init__(2 ** 31 - 1)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = {}  # (chat_id, user_id) -> [lock, updates holding or waiting for it]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, 'effective_user', None)
+        chat = getattr(update, 'effective_chat', None)
+        if user is None and chat is None:
+            async with self._slots:
+                await coroutine
+            return
+        key = (chat and chat.id, user and user.id)
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves metrics.render() on /metrics."""
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would flood the bot's log
+        pass
+
+def start_metrics_server(host, port):
+    server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+render_metrics = RenderMetrics(METRICS_WINDOW, metrics)
+
+class RenderWorkerCrashed(Exception):
+    """Raised for a render whose worker process died or was stopped while running it."""
+
+def _init_render_worker():
+    # Worker processes don't inherit the parent's fonts, each loads its own
+    font_registry.preload()
+
+def _render_farm_worker(conn):
+    """Main loop of a render farm process: run jobs from the pipe and send back results."""
+    _init_render_worker()
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        func, args = job
+        try:
+            result = (True, func(*args))
+        except Exception as e:
+            result = (False, e)
+        try:
+            conn.send(result)
+        except Exception as e:
+            # The result or exception couldn't be pickled
+            conn.send((False, RuntimeError(f"Render result could not be sent back: {e!r}")))
+
+class RenderFarm(Executor):
+    """Render worker processes fed over pipes, with jobs routed by user.
+
+    Every worker process has its own FIFO and a dispatcher thread in this
+    process that feeds it one job at a time. While a user has jobs in flight
+    they all go to the same worker so they finish in order; otherwise the
+    least busy worker is picked. A worker that dies is replaced and only the
+    job it was running fails, with RenderWorkerCrashed; a job that never
+    reached a worker is sent to the replacement instead. When no worker can
+    be started, jobs fail with RenderWorkerCrashed until one can.
+    """
+
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+        self.restarts = 0
+        # Workers are started and restarted while this process runs threads,
+        # so they come from a fork server rather than forking this process
+        self._context = multiprocessing.get_context(RENDER_START_METHOD)
+        self._lock = threading.Lock()
+        self._queues = [queue.Queue() for _ in range(self.workers)]
+        self._pending = [0] * self.workers
+        self._running = [None] * self.workers  # (future, process) per worker
+        self._routes = {}  # route key -> [worker index, jobs in flight]
+        self._round_robin = 0
+        self._threads = []
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self._dispatch, args=(index,), name=f'render-farm-{index}', daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def _spawn(self):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_render_farm_worker, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+
+    def submit(self, fn, /, *args, **kwargs):
+        if kwargs:
+            raise TypeError("RenderFarm jobs only take positional arguments")
+        return self.submit_routed(None, fn, *args)
+
+    def submit_routed(self, key, fn, *args):
+        """Queue ``fn(*args)``; jobs with the same non-None ``key`` run in order on one worker."""
+        future = Future()
+        with self._lock:
+            route = self._routes.get(key) if key is not None else None
+            if route is None:
+                index = min(
+                    range(self.workers),
+                    key=lambda i: (self._pending[i], (i - self._round_robin) % self.workers)
+                )
+                self._round_robin = (index + 1) % self.workers
+                if key is not None:
+                    route = self._routes[key] = [index, 0]
+            else:
+                index = route[0]
+            if route is not None:
+                route[1] += 1
+            self._pending[index] += 1
+        future.add_done_callback(lambda _: self._job_done(index, key))
+        self._queues[index].put((future, fn, args))
+        return future
+
+    def _job_done(self, index, key):
+        with self._lock:
+            self._pending[index] -= 1
+            route = self._routes.get(key)
+            if route is not None:
+                route[1] -= 1
+                if route[1] <= 0:
+                    del self._routes[key]
+
+    def abort(self, future):
+        """Stop a job: cancel it if queued, kill its worker if it is running."""
+        with self._lock:
+            if future.cancel():
+                return
+            running = [entry for entry in self._running if entry is not None and entry[0] is future]
+        if running:
+            logger.warning("Stopping render worker to abort a job")
+            running[0][1].terminate()
+
+    def _start_worker(self, index):
+        """Start a worker process; returns None when that fails."""
+        try:
+            return self._spawn()
+        except Exception as e:
+            logger.error(f"Could not start render worker {index}: {e!r}")
+            return None
+
+    def _reap(self, index, worker):
+        process, conn = worker
+        if process.is_alive():
+            process.terminate()
+        process.join(timeout=5)
+        conn.close()
+        logger.error(f"Render worker {index} (pid {process.pid}) exited with {process.exitcode}, restarting it")
+        self.restarts += 1
+
+    def _dispatch(self, index):
+        worker = self._start_worker(index)
+        while True:
+            job = self._queues[index].get()
+            if job is None:
+                if worker is not None:
+                    process, conn = worker
+                    with contextlib.suppress(OSError):
+                        conn.send(None)
+                    process.join(timeout=5)
+                    conn.close()
+                return
+            future, fn, args = job
+            with self._lock:
+                if not future.set_running_or_notify_cancel():
+                    continue
+            try:
+                worker = self._run_job(index, worker, future, fn, args)
+            finally:
+                with self._lock:
+                    self._running[index] = None
+
+    def _run_job(self, index, worker, future, fn, args):
+        """Run one job and return the worker for the next one, None if none could be started."""
+        for _ in range(2):
+            if worker is not None and not worker[0].is_alive():
+                # It died while idle; the job wasn't sent, so it just goes to a new worker
+                self._reap(index, worker)
+                worker = None
+            if worker is None:
+                worker = self._start_worker(index)
+                if worker is None:
+                    future.set_exception(RenderWorkerCrashed(f"render worker {index} could not be started"))
+                    return None
+            process, conn = worker
+            with self._lock:
+                self._running[index] = (future, process)
+            try:
+                conn.send((fn, args))
+            except OSError:
+                # The worker went away before it got the job, try a new one
+                self._reap(index, worker)
+                worker = None
+                continue
+            except Exception as e:
+                # The job itself couldn't be pickled
+                future.set_exception(e)
+                return worker
+            try:
+                # A dead worker doesn't always show up as EOF (a forked sibling
+                # can hold the pipe open), so watch the process sentinel too
+                ready = multiprocessing.connection.wait([conn, process.sentinel])
+                if conn not in ready:
+                    raise EOFError()
+                ok, result = conn.recv()
+            except (EOFError, OSError):
+                self._reap(index, worker)
+                future.set_exception(RenderWorkerCrashed(f"render worker {index} died"))
+                return self._start_worker(index)
+            except Exception as e:
+                # The result couldn't be unpickled
+                future.set_exception(e)
+                return worker
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+            return worker
+        future.set_exception(RenderWorkerCrashed(f"render worker {index} died before taking the job"))
+        return None
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        for job_queue in self._queues:
+            job_queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+class RenderPool:
+    """Runs thumbnail renders off the event loop with a bounded wait queue.
+
+    At most ``workers`` renders run at once; up to ``queue_size`` more wait in
+    FIFO order and anything beyond that is rejected with RenderQueueFull.
+    A worker slot is only freed once its render has really finished, so a job
+    that timed out or was cancelled still counts against the pool until the
+    worker returns. With the render farm the worker is stopped instead.
+    """
+
+    def __init__(self, workers, queue_size, timeout, executor_kind='thread'):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.executor_kind = executor_kind
+        self._executor = None
+        self._active = 0
+        self._waiters = OrderedDict()  # job token -> future resolved when a slot is handed over
+        self._cancels = {}  # job token -> future resolved by cancel()
+        self._jobs = {}  # user_id -> tokens of that user's queued and running jobs
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.executor_kind == 'farm':
+                self._executor = RenderFarm(self.workers)
+            elif self.executor_kind == 'process':
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context(RENDER_START_METHOD),
+                    initializer=_init_render_worker
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='render')
+        return self._executor
+
+    @property
+    def restarts(self):
+        """Render farm workers replaced so far; other executors don't restart workers."""
+        return getattr(self._executor, 'restarts', 0)
+
+    def cancel(self, user_id):
+        """Cancel every queued or running render of a user. Returns True if there was one."""
+        found = False
+        for token in self._jobs.get(user_id, ()):
+            cancelled = self._cancels[token]
+            if not cancelled.done():
+                cancelled.set_result(None)
+                found = True
+        return found
+
+    async def run(self, user_id, func, *args, on_queued=None, route=None):
+        """Run ``func(*args)`` on a worker and return its result.
+
+        ``on_queued`` is awaited with the queue position when the job has to
+        wait for a free worker. On the render farm jobs with the same ``route``
+        (the user by default) run in order on one worker.
+        """
+        loop = asyncio.get_running_loop()
+        token = object()
+        cancelled = self._cancels[token] = loop.create_future()
+        self._jobs.setdefault(user_id, set()).add(token)
+        try:
+            queued_at = time.perf_counter()
+            await self._acquire(token, cancelled, on_queued)
+            metrics.observe('render_queue_wait_seconds', time.perf_counter() - queued_at)
+            if isinstance(self.executor, RenderFarm):
+                farm_job = self.executor.submit_routed(user_id if route is None else route, func, *args)
+                job = asyncio.wrap_future(farm_job)
+            else:
+                farm_job = None
+                job = loop.run_in_executor(self.executor, func, *args)
+            job.add_done_callback(self._release)
+            done, _ = await asyncio.wait(
+                {job, cancelled}, timeout=self.timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if job in done:
+                return job.result()
+            # Nobody waits for the abandoned job any more, retrieve its outcome
+            # so a late failure isn't reported as never retrieved
+            job.add_done_callback(lambda job: job.cancelled() or job.exception())
+            if farm_job is not None:
+                # Farm workers can be stopped, which frees the slot right away
+                self.executor.abort(farm_job)
+            if cancelled in done:
+                raise RenderCancelled()
+            raise asyncio.TimeoutError()
+        finally:
+            del self._cancels[token]
+            tokens = self._jobs[user_id]
+            tokens.discard(token)
+            if not tokens:
+                del self._jobs[user_id]
+
+    async def _acquire(self, token, cancelled, on_queued):
+        if self._active < self.workers and not self._waiters:
+            self._active += 1
+            return
+        if len(self._waiters) >= self.queue_size:
+            raise RenderQueueFull()
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[token] = waiter
+        try:
+            if on_queued is not None:
+                await on_queued(len(self._waiters))
+            # A queued job gives up after the render timeout too
+            await asyncio.wait({waiter, cancelled}, timeout=self.timeout, return_when=asyncio.FIRST_COMPLETED)
+            if cancelled.done() and not waiter.done():
+                raise RenderCancelled()
+            if not waiter.done():
+                raise asyncio.TimeoutError()
+        except BaseException:
+            self._waiters.pop(token, None)
+            if waiter.done() and not waiter.cancelled():
+                # A slot was already handed to us, pass it on
+                self._release()
+            waiter.cancel()
+            raise
+
+    def _release(self, _job=None):
+        # Hand the slot straight to the next waiter so new arrivals can't jump the queue
+        while self._waiters:
+            _, waiter = self._waiters.popitem(last=False)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+async def run_render(user_id, data, func, *args, on_queued=None, route=None):
+    """Run a render on the pool and record its stage timings for ``data``."""
+    if not RENDER_METRICS:
+        return await render_pool.run(user_id, func, *args, on_queued=on_queued, route=route)
+    try:
+        result, stages, total = await render_pool.run(
+            user_id, timed_render, func, *args, on_queued=on_queued, route=route
+        )
+    except (RenderCancelled, RenderQueueFull):
+        raise
+    except Exception:
+        render_metrics.record_failure()
+        raise
+    render_metrics.record(data, stages, total)
+    return result
+
+async def render_profiles(user_id, data, profiles, on_queued=None, route=None):
+    """Return {profile name: image bytes} for ``data``.
+
+    Every profile comes out of one render and is cached next to the others,
+    so the render is skipped when all of them are in the cache.
+    """
+    digests = {
+        name: thumbnail_digest(data, image_format, quality, size)
+        for name, (size, image_format, quality) in profiles.items()
+    }
+    images = {name: render_cache.get(digest) for name, digest in digests.items()}
+    if all(image is not None for image in images.values()):
+        return images
+    images = await run_render(
+        user_id, data, generate_thumbnail, None, data, THUMBNAIL_FORMAT, THUMBNAIL_QUALITY, profiles,
+        on_queued=on_queued, route=route
+    )
+    for name, image in images.items():
+        render_cache.put(digests[name], image)
+    return images
+
+class FontRegistry:
+    """Process-wide cache of loaded fonts keyed by (font path, size).
+
+    Every FONTS x template font size combination, including the sizes fit_text
+    can shrink to, is loaded once by preload() and kept
+    for the life of the process. Any other font or size is held in an LRU of
+    ``max_custom`` entries. A font that fails to load is remembered, so the
+    default font is returned straight away on later renders.
+    """
+
+    def __init__(self, max_custom):
+        self.max_custom = max_custom
+        self._lock = threading.Lock()
+        self._builtin = {}
+        self._custom = OrderedDict()
+        self._missing = set()
+        self._default = None
+        self._builtin_sizes = set()
+
+    def preload(self):
+        """Load every built-in font at every size the templates use."""
+        self._builtin_sizes = set().union(*(plan.font_sizes for plan in template_plans.values()))
+        for font_file in FONTS.values():
+            for size in self._builtin_sizes:
+                self.get(f"fonts/{font_file}", size)
+        logger.info(
+            f"Preloaded {len(self._builtin)} fonts, {len(self._missing)} font files missing"
+        )
+
+    def default_font(self):
+        if self._default is None:
+            self._default = ImageFont.load_default()
+        return self._default
+
+    def is_builtin(self, path):
+        return path.startswith("fonts/") and path[len("fonts/"):] in FONTS.values()
+
+    def get(self, path, size):
+        """Return the font for ``path`` at ``size``, falling back to the default font."""
+        key = (path, size)
+        with self._lock:
+            font = self._builtin.get(key)
+            if font is not None:
+                return font
+            font = self._custom.get(key)
+            if font is not None:
+                self._custom.move_to_end(key)
+                return font
+            if path in self._missing:
+                return self.default_font()
+
+        try:
+            font = ImageFont.truetype(path, size)
+        except OSError as e:
+            logger.warning(f"Could not load font {path}, using the default font: {e}")
+            with self._lock:
+                self._missing.add(path)
+            return self.default_font()
+
+        with self._lock:
+            if self.is_builtin(path) and size in self._builtin_sizes:
+                self._builtin[key] = font
+            else:
+                self._custom[key] = font
+                while len(self._custom) > self.max_custom:
+                    self._custom.popitem(last=False)
+        return font
+
+font_registry = FontRegistry(FONT_CACHE_SIZE)
+
+class RenderCache:
+    """Cache of encoded thumbnails keyed by thumbnail_digest().
+
+    Images are kept in an LRU bounded to ``max_bytes`` and, when ``cache_dir``
+    is set, also written there so they survive eviction and restarts. The
+    directory is an LRU of its own bounded to ``max_disk_bytes``; an evicted
+    image takes its file_id with it. The Telegram file_id of the first upload
+    is remembered so a repeat can be sent again without uploading the image.
+    """
+
+    def __init__(self, max_bytes, cache_dir=None, max_disk_bytes=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.size = 0
+        self.disk_size = 0
+        self._images = OrderedDict()
+        self._file_ids = OrderedDict()
+        self._disk = OrderedDict()  # digest -> size of its image file, least recently used first
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._scan_disk()
 
+    def _path(self, digest, suffix):
+        return os.path.join(self.cache_dir, f"{digest}.{suffix}")
+
+    def _scan_disk(self):
+        # Pick up images written by earlier runs, oldest use first
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.img'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-len('.img')], stat.st_size))
+        for _, digest, size in sorted(files):
+            self._disk[digest] = size
+            self.disk_size += size
+        self._trim_disk()
+
+    def _trim_disk(self):
+        while self.max_disk_bytes is not None and self.disk_size > self.max_disk_bytes and self._disk:
+            digest, size = self._disk.popitem(last=False)
+            self.disk_size -= size
+            self._file_ids.pop(digest, None)
+            for suffix in ('img', 'id'):
+                try:
+                    os.remove(self._path(digest, suffix))
+                except FileNotFoundError:
+                    pass
+
+    def get(self, digest):
+        """Return the cached image bytes for ``digest`` or None."""
+        image = self._images.get(digest)
+        if image is not None:
+            self._images.move_to_end(digest)
+            return image
+        if self.cache_dir:
+            try:
+                with open(self._path(digest, 'img'), 'rb') as f:
+                    image = f.read()
+                # Keep the recency across restarts too
+                os.utime(self._path(digest, 'img'))
+            except FileNotFoundError:
+                self.disk_size -= self._disk.pop(digest, 0)
+                return None
+            # The image may have been written by another process
+            self.disk_size += len(image) - self._disk.pop(digest, 0)
+            self._disk[digest] = len(image)
+            self._trim_disk()
+            self._remember(digest, image)
+            return image
+        return None
+
+    def put(self, digest, image):
+        self._remember(digest, image)
+        if self.cache_dir:
+            # Write then rename so readers never see a partial file
+            tmp_path = self._path(digest, 'tmp')
+            with open(tmp_path, 'wb') as f:
+                f.write(image)
+            os.replace(tmp_path, self._path(digest, 'img'))
+            self.disk_size += len(image) - self._disk.pop(digest, 0)
+            self._disk[digest] = len(image)
+            self._trim_disk()
+
+    def _remember(self, digest, image):
+        if len(image) > self.max_bytes:
+            return
+        old = self._images.pop(digest, None)
+        if old is not None:
+            self.size -= len(old)
+        self._images[digest] = image
+        self.size += len(image)
+        while self.size > self.max_bytes:
+            _, evicted = self._images.popitem(last=False)
+            self.size -= len(evicted)
+
+    def get_file_id(self, digest):
+        """Return the Telegram file_id of an earlier upload of ``digest`` or None."""
+        file_id = self._file_ids.get(digest)
+        if file_id is None and self.cache_dir and os.path.exists(self._path(digest, 'id')):
+            with open(self._path(digest, 'id')) as f:
+                file_id = f.read().strip()
+            self._file_ids[digest] = file_id
+        return file_id
+
+    def set_file_id(self, digest, file_id):
+        # file_ids are tiny, so just cap how many are held in memory
+        self._file_ids[digest] = file_id
+        self._file_ids.move_to_end(digest)
+        while len(self._file_ids) > 10000:
+            self._file_ids.popitem(last=False)
+        if self.cache_dir:
+            with open(self._path(digest, 'id'), 'w') as f:
+                f.write(file_id)
+
+    def forget_file_id(self, digest):
+        self._file_ids.pop(digest, None)
+        if self.cache_dir and os.path.exists(self._path(digest, 'id')):
+            os.remove(self._path(digest, 'id'))
+
+render_cache = RenderCache(RENDER_CACHE_BYTES, RENDER_CACHE_DIR, RENDER_CACHE_DISK_BYTES)
+
+class StaticLayerCache:
+    """LRU of pre-drawn static layers keyed by (template_style, color_scheme, text_style).
+
+    get() returns a fresh copy that the caller is free to draw on.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._layers = OrderedDict()
+
+    def get(self, template_style, color_scheme, text_style):
+        key = (template_style, color_scheme, text_style)
+        with self._lock:
+            layer = self._layers.get(key)
+            if layer is not None:
+                self._layers.move_to_end(key)
+                return layer.copy()
+        
+        layer = build_static_layer(template_style, color_scheme, text_style)
+        with self._lock:
+            self._layers[key] = layer
+            while len(self._layers) > self.max_entries:
+                self._layers.popitem(last=False)
+        return layer.copy()
+
+static_layers = StaticLayerCache(STATIC_LAYER_CACHE_SIZE)
+
+render_pool = RenderPool(
+    RENDER_WORKERS, RENDER_QUEUE_SIZE, RENDER_TIMEOUT,
+    executor_kind=RENDER_EXECUTOR
+)
+metrics.gauge('render_pool_busy', "Render workers currently busy.", lambda: render_pool._active)
+metrics.gauge('render_pool_queued', "Renders waiting for a free worker.", lambda: len(render_pool._waiters))
+metrics.gauge('render_worker_restarts', "Render farm worker processes replaced after dying.", lambda: render_pool.restarts)
+
+class TokenBuckets:
+    """One token bucket per key, refilled at ``per_minute`` tokens up to ``burst``.
+
+    Only buckets that are not full are stored, so idle users cost nothing.
+    """
+
+    def __init__(self, per_minute, burst, max_keys=10000):
+        self.rate = per_minute / 60
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self._prune_at = max_keys
+        self._buckets = {}  # key -> (tokens, monotonic time of the last update)
+
+    def _tokens(self, key, now):
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def wait(self, key, now):
+        """Seconds until ``key`` has a token; 0 when it has one now."""
+        if not self.rate:
+            return 0.0
+        return max(0.0, (1 - self._tokens(key, now)) / self.rate)
+
+    def take(self, key, now):
+        """Take a token, going into debt if the caller is going to wait for it."""
+        if not self.rate:
+            return
+        self._buckets[key] = (self._tokens(key, now) - 1, now)
+        if len(self._buckets) > self._prune_at:
+            self._buckets = {
+                key: (tokens, updated) for key, (tokens, updated) in self._buckets.items()
+                if tokens + (now - updated) * self.rate < self.burst
+            }
+            # Buckets still refilling stay, so don't rescan before the map doubles
+            self._prune_at = max(self.max_keys, 2 * len(self._buckets))
+
+class AdmissionControl:
+    """Decides whether a render job may start, before any image work is done.
+
+    A job needs a token from its user's and its chat's bucket. When a token
+    is due within ``max_delay`` seconds the job waits for it, otherwise it
+    is dropped. Admitted jobs hold ``units`` of the in-flight budget until
+    release() is called; a job that doesn't fit the budget is dropped.
+    """
+
+    def __init__(self, user_buckets, chat_buckets, budget, max_delay):
+        self.users = user_buckets
+        self.chats = chat_buckets
+        self.budget = budget
+        self.max_delay = max_delay
+        self.in_flight = 0
+
+    async def acquire(self, user_id, chat_id, path, units=1):
+        """Admit a job or raise AdmissionRejected; the caller must release(units) after."""
+        units = min(units, self.budget)
+        now = time.monotonic()
+        user_wait = self.users.wait(user_id, now)
+        chat_wait = self.chats.wait(chat_id, now)
+        if max(user_wait, chat_wait) > self.max_delay:
+            reason = 'user' if user_wait >= chat_wait else 'chat'
+            self._drop(path, reason)
+            raise AdmissionRejected(reason, max(user_wait, chat_wait))
+        if self.in_flight + units > self.budget:
+            self._drop(path, 'busy')
+            raise AdmissionRejected('busy', self.max_delay)
+        
+        self.users.take(user_id, now)
+        self.chats.take(chat_id, now)
+        self.in_flight += units
+        delay = max(user_wait, chat_wait)
+        if not delay:
+            metrics.inc('admission_jobs_total', path=path, outcome='accepted')
+            return
+        metrics.inc('admission_jobs_total', path=path, outcome='delayed')
+        try:
+            await asyncio.sleep(delay)
+        except BaseException:
+            self.release(units)
+            raise
+
+    def release(self, units=1):
+        self.in_flight -= min(units, self.budget)
+
+    def _drop(self, path, reason):
+        metrics.inc('admission_jobs_total', path=path, outcome='dropped')
+        metrics.inc('admission_drops_total', path=path, reason=reason)
+
+admission = AdmissionControl(
+    TokenBuckets(RATE_LIMIT_USER_PER_MINUTE, RATE_LIMIT_USER_BURST),
+    TokenBuckets(RATE_LIMIT_CHAT_PER_MINUTE, RATE_LIMIT_CHAT_BURST),
+    ADMISSION_BUDGET or render_pool.workers + render_pool.queue_size,
+    RATE_LIMIT_MAX_DELAY
+)
+metrics.counter('admission_jobs_total', "Render jobs accepted, delayed for a token, or dropped, by path.")
+metrics.counter('admission_drops_total', "Render jobs dropped by admission control, by reason.")
+metrics.gauge('admission_in_flight', "Budget units held by admitted render jobs.", lambda: admission.in_flight)
+
+def admission_message(rejected):
+    """The reply sent for a job admission control dropped."""
+    if rejected.reason == 'busy':
+        return "The bot is very busy right now. Please try again in a minute."
+    return f"You're making thumbnails too quickly. Please try again in {int(rejected.retry_after) + 1} seconds."
+
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Start the conversation and ask for the manga name."""
     user_id = update.message.from_user.id
-    user_sessions[user_id] = {'data': {}}
+    await user_sessions.new(user_id)
     
     await update.message.reply_text(
         "🎌 Welcome to Manga Thumbnail Generator! 🎌\n\n"
@@ -82,41 +1790,79 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return MANGA_NAME
 
+@timed_handler
+@with_session
 async def manga_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the manga name and ask for the manga profile picture."""
     user_id = update.message.from_user.id
-    user_sessions[user_id]['data']['manga_name'] = update.message.text
+    await user_sessions.set(user_id, 'manga_name', update.message.text)
     
     await update.message.reply_text(
         "Great! Now please send me the manga profile picture (send as image):"
     )
     return MANGA_PFP
 
+def pick_photo_size(photo_sizes, min_side):
+    """Return the smallest PhotoSize whose shorter side is at least ``min_side``.
+    
+    Falls back to the largest size when none is big enough.
+    """
+    for photo_size in sorted(photo_sizes, key=lambda p: p.width * p.height):
+        if min(photo_size.width, photo_size.height) >= min_side:
+            return photo_size
+    return max(photo_sizes, key=lambda p: p.width * p.height)
+
+@timed_handler
+@with_session
 async def manga_pfp(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the manga profile picture and ask for synopsis."""
     user_id = update.message.from_user.id
     
-    # Get the photo file
-    photo_file = await update.message.photo[-1].get_file()
+    # Get the smallest photo size that still covers the avatar
+    avatar_size = max(TEMPLATE_AVATAR_SIZES.values())
+    photo = pick_photo_size(update.message.photo, avatar_size)
+    if photo.file_size and photo.file_size > MAX_COVER_BYTES:
+        await update.message.reply_text("That picture is too large. Please send a smaller one:")
+        return MANGA_PFP
+    
+    photo_file = await photo.get_file()
     img_data = BytesIO()
     await photo_file.download_to_memory(out=img_data)
-    user_sessions[user_id]['data']['manga_pfp'] = img_data.getvalue()
+    
+    # Keep only the reduced avatar in the session, decoded on the render pool
+    # so it takes a worker slot like any render
+    try:
+        avatar = await render_pool.run(
+            user_id, normalize_avatar, img_data.getvalue(), avatar_size
+        )
+    except (RenderQueueFull, asyncio.TimeoutError):
+        await update.message.reply_text("The bot is very busy right now. Please send the picture again in a minute:")
+        return MANGA_PFP
+    except (ValueError, OSError, Image.DecompressionBombError) as e:
+        logger.warning(f"Rejected cover image from user {user_id}: {e}")
+        await update.message.reply_text("Sorry, I couldn't use that picture. Please send another one:")
+        return MANGA_PFP
+    await user_sessions.set(user_id, 'manga_pfp', avatar)
     
     await update.message.reply_text(
         "Perfect! Now please send the manga synopsis:"
     )
     return SYNOPSIS
 
+@timed_handler
+@with_session
 async def synopsis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the synopsis and ask for percentage."""
     user_id = update.message.from_user.id
-    user_sessions[user_id]['data']['synopsis'] = update.message.text
+    await user_sessions.set(user_id, 'synopsis', update.message.text)
     
     await update.message.reply_text(
         "Got it! What percentage score would you like to display? (e.g., 86):"
     )
     return PERCENTAGE
 
+@timed_handler
+@with_session
 async def percentage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the percentage and ask for year."""
     user_id = update.message.from_user.id
@@ -124,7 +1870,7 @@ async def percentage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         percent = int(update.message.text)
         if percent < 0 or percent > 100:
             raise ValueError
-        user_sessions[user_id]['data']['percentage'] = percent
+        await user_sessions.set(user_id, 'percentage', percent)
     except ValueError:
         await update.message.reply_text("Please enter a valid percentage between 0 and 100:")
         return PERCENTAGE
@@ -134,12 +1880,14 @@ async def percentage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return YEAR
 
+@timed_handler
+@with_session
 async def year(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the year and ask for author."""
     user_id = update.message.from_user.id
     try:
         year = int(update.message.text)
-        user_sessions[user_id]['data']['year'] = year
+        await user_sessions.set(user_id, 'year', year)
     except ValueError:
         await update.message.reply_text("Please enter a valid year:")
         return YEAR
@@ -149,10 +1897,12 @@ async def year(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return AUTHOR
 
+@timed_handler
+@with_session
 async def author(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the author and ask for template style."""
     user_id = update.message.from_user.id
-    user_sessions[user_id]['data']['author'] = update.message.text
+    await user_sessions.set(user_id, 'author', update.message.text)
     
     # Create keyboard for template selection
     reply_keyboard = [list(TEMPLATES.keys())]
@@ -163,10 +1913,12 @@ async def author(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return TEMPLATE_STYLE
 
+@timed_handler
+@with_session
 async def template_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the template style and ask for color scheme."""
     user_id = update.message.from_user.id
-    user_sessions[user_id]['data']['template_style'] = TEMPLATES.get(update.message.text, "default")
+    await user_sessions.set(user_id, 'template_style', TEMPLATES.get(update.message.text, "default"))
     
     # Create keyboard for color selection
     reply_keyboard = [list(COLORS.keys())]
@@ -177,6 +1929,8 @@ async def template_style(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     )
     return COLOR_SCHEME
 
+@timed_handler
+@with_session
 async def color_scheme(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the color scheme and ask for text style."""
     user_id = update.message.from_user.id
@@ -191,9 +1945,25 @@ async def color_scheme(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     elif selected_color == "Random":
         # Generate a random color
         random_color = "#{:06x}".format(random.randint(0, 0xFFFFFF))
-        user_sessions[user_id]['data']['color_scheme'] = random_color
+        await user_sessions.set(user_id, 'color_scheme', random_color)
+    elif selected_color == "Auto":
+        # Take the color from the cover on the render pool, which bounds
+        # how many of these run at once like any other image work
+        data = (await user_sessions.get(user_id))['data']
+        backdrop = template_plan(data['template_style']).backdrop
+        try:
+            color = await render_pool.run(user_id, auto_color, data['manga_pfp'], backdrop)
+        except (RenderQueueFull, asyncio.TimeoutError):
+            await update.message.reply_text(
+                "The bot is very busy right now. Please choose a color scheme again in a minute:",
+                reply_markup=ReplyKeyboardMarkup([list(COLORS.keys())], one_time_keyboard=True)
+            )
+            return COLOR_SCHEME
+        except RenderCancelled:
+            return ConversationHandler.END
+        await user_sessions.set(user_id, 'color_scheme', color)
     else:
-        user_sessions[user_id]['data']['color_scheme'] = COLORS[selected_color]
+        await user_sessions.set(user_id, 'color_scheme', COLORS[selected_color])
     
     # Create keyboard for font selection
     reply_keyboard = [list(FONTS.keys())]
@@ -204,6 +1974,8 @@ async def color_scheme(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     )
     return TEXT_STYLE
 
+@timed_handler
+@with_session
 async def custom_color(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle custom color input."""
     user_id = update.message.from_user.id
@@ -211,10 +1983,10 @@ async def custom_color(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     
     # Validate color input (simple check)
     if color_input.startswith('#') and len(color_input) == 7:
-        user_sessions[user_id]['data']['color_scheme'] = color_input
+        await user_sessions.set(user_id, 'color_scheme', color_input)
     else:
         # Try to use color name
-        user_sessions[user_id]['data']['color_scheme'] = color_input
+        await user_sessions.set(user_id, 'color_scheme', color_input)
     
     # Create keyboard for font selection
     reply_keyboard = [list(FONTS.keys())]
@@ -225,10 +1997,12 @@ async def custom_color(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     )
     return TEXT_STYLE
 
+@timed_handler
+@with_session
 async def text_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the text style and ask for branding."""
     user_id = update.message.from_user.id
-    user_sessions[user_id]['data']['text_style'] = FONTS.get(update.message.text, "arial.ttf")
+    await user_sessions.set(user_id, 'text_style', FONTS.get(update.message.text, "arial.ttf"))
     
     await update.message.reply_text(
         "What branding text would you like to display? (e.g., 'waalords'):",
@@ -236,23 +2010,26 @@ async def text_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return BRANDING
 
+@timed_handler
+@with_session
 async def branding(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the branding and show confirmation."""
     user_id = update.message.from_user.id
-    user_sessions[user_id]['data']['branding'] = update.message.text
+    await user_sessions.set(user_id, 'branding', update.message.text)
+    data = (await user_sessions.get(user_id))['data']
     
     # Show summary of choices
     summary = f"""
     Here's your manga thumbnail configuration:
     
-    Name: {user_sessions[user_id]['data']['manga_name']}
-    Author: {user_sessions[user_id]['data']['author']}
-    Year: {user_sessions[user_id]['data']['year']}
-    Percentage: {user_sessions[user_id]['data']['percentage']}%
-    Template: {user_sessions[user_id]['data']['template_style']}
-    Color: {user_sessions[user_id]['data']['color_scheme']}
-    Font: {user_sessions[user_id]['data']['text_style']}
-    Branding: {user_sessions[user_id]['data']['branding']}
+    Name: {data['manga_name']}
+    Author: {data['author']}
+    Year: {data['year']}
+    Percentage: {data['percentage']}%
+    Template: {data['template_style']}
+    Color: {data['color_scheme']}
+    Font: {data['text_style']}
+    Branding: {data['branding']}
     
     Would you like to generate the thumbnail now? (yes/no)
     """
@@ -260,147 +2037,1192 @@ async def branding(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text(summary)
     return CONFIRMATION
 
+@timed_handler
+@with_session
 async def confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle confirmation and generate thumbnail."""
     user_id = update.message.from_user.id
     response = update.message.text.lower()
     
-    if response == 'yes':
+    if response != 'yes':
+        await user_sessions.pop(user_id)
+        await update.message.reply_text("Thumbnail generation cancelled.")
+        return ConversationHandler.END
+    
+    # Rate limits and the render budget are checked before anything else,
+    # a dropped job keeps its session so the user can confirm again
+    try:
+        await admission.acquire(user_id, update.message.chat_id, 'confirmation')
+    except AdmissionRejected as e:
+        await update.message.reply_text(admission_message(e) + " Send yes when you're ready.")
+        return CONFIRMATION
+    try:
+        return await send_thumbnail(update, user_id)
+    finally:
+        admission.release()
+
+async def send_thumbnail(update, user_id):
+    """Render the thumbnail of a user's session, or re-send an identical one, and end the conversation."""
+    # The conversation ends here either way, so the session can go
+    session = await user_sessions.pop(user_id)
+    if session is None:
+        # Expired while the job waited for a token
+        await update.message.reply_text("Your session has expired. Send /start to begin again.")
+        return ConversationHandler.END
+    data = session['data']
+    
+    async def notify_queued(position):
+        await update.message.reply_text(
+            f"All renderers are busy right now, you're queued, position {position}."
+        )
+    
+    try:
+        digest = thumbnail_digest(data)
         await update.message.reply_text("Generating your manga thumbnail... Please wait.")
         
-        # Generate the thumbnail
-        try:
-            thumbnail_path = generate_thumbnail(user_id)
-            
-            # Send the generated image
-            with open(thumbnail_path, 'rb') as photo:
-                await update.message.reply_photo(photo=photo, caption="Here's your manga thumbnail!")
-            
-            # Clean up
-            os.remove(thumbnail_path)
-            
-        except Exception as e:
-            logger.error(f"Error generating thumbnail: {e}")
-            await update.message.reply_text("Sorry, there was an error generating your thumbnail. Please try again.")
+        # An identical thumbnail was uploaded before, re-send it by file_id
+        file_id = render_cache.get_file_id(digest)
+        if file_id is not None:
+            try:
+                await update.message.reply_photo(photo=file_id, caption="Here's your manga thumbnail!")
+                metrics.observe('conversation_seconds', time.time() - session['created_at'])
+                return ConversationHandler.END
+            except BadRequest:
+                render_cache.forget_file_id(digest)
         
-        # End conversation
-        return ConversationHandler.END
-    else:
-        await update.message.reply_text("Thumbnail generation cancelled.")
-        return ConversationHandler.END
+        # Generate the thumbnail on the render pool so other chats aren't blocked.
+        # Only the full size is sent here, the other profiles are for batches.
+        images = await render_profiles(
+            user_id, data, {'full': OUTPUT_PROFILES['full']}, on_queued=notify_queued
+        )
+        thumbnail = images['full']
+        
+        # Send the generated image straight from memory
+        message = await update.message.reply_photo(
+            photo=thumbnail,
+            filename=f"thumbnail.{OUTPUT_FORMATS[THUMBNAIL_FORMAT]}",
+            caption="Here's your manga thumbnail!"
+        )
+        render_cache.set_file_id(digest, message.photo[-1].file_id)
+        metrics.observe('conversation_seconds', time.time() - session['created_at'])
+        
+    except RenderQueueFull:
+        await update.message.reply_text("The bot is very busy right now. Please try again in a minute.")
+    except RenderCancelled:
+        # /cancel already answered the user
+        pass
+    except asyncio.TimeoutError:
+        logger.error(f"Thumbnail render for user {user_id} timed out after {render_pool.timeout}s")
+        await update.message.reply_text("Sorry, generating your thumbnail took too long. Please try again.")
+    except Exception as e:
+        logger.error(f"Error generating thumbnail: {e}")
+        await update.message.reply_text("Sorry, there was an error generating your thumbnail. Please try again.")
+    
+    # End conversation
+    return ConversationHandler.END
 
+@timed_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancel the conversation."""
+    user_id = update.message.from_user.id
+    for stopped in batch_jobs.pop(user_id, ()):
+        stopped.set()
+    render_pool.cancel(user_id)
+    await user_sessions.pop(user_id)
+    
     await update.message.reply_text(
         'Thumbnail generation cancelled.', reply_markup=ReplyKeyboardRemove()
     )
     return ConversationHandler.END
 
-def generate_thumbnail(user_id):
-    """Generate the manga thumbnail based on user preferences."""
-    data = user_sessions[user_id]['data']
+@timed_handler
+async def batch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Start a batch render and ask for the manifest file."""
+    user_id = update.message.from_user.id
+    if user_id not in ADMIN_IDS:
+        await update.message.reply_text("Batch rendering is only available to bot admins.")
+        return ConversationHandler.END
     
-    # Create a blank image
-    width, height = 800, 1000
-    img = Image.new('RGB', (width, height), color='white')
-    draw = ImageDraw.Draw(img)
+    context.user_data['batch_zip'] = 'zip' in [arg.lower() for arg in context.args]
+    await update.message.reply_text(
+        "Send me the manifest as a .jsonl or .csv file. Each row needs manga_name, synopsis, "
+        "percentage, year, author, template, color, font, branding and image (an http(s) URL).\n\n"
+        "Use /batch zip to get the thumbnails as one ZIP file instead of photos."
+    )
+    return BATCH_MANIFEST
+
+@timed_handler
+async def batch_manifest(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Render every row of an uploaded manifest and send the results back."""
+    user_id = update.message.from_user.id
+    document = update.message.document
+    if document.file_size and document.file_size > BATCH_MAX_MANIFEST_BYTES:
+        await update.message.reply_text("That manifest is too large.")
+        return ConversationHandler.END
     
-    # Get the primary color
-    primary_color = data['color_scheme']
+    # A batch renders up to a worker's worth of rows at once, so it holds
+    # that much of the admission budget until it is done
+    try:
+        await admission.acquire(user_id, update.message.chat_id, 'batch', render_pool.workers)
+    except AdmissionRejected as e:
+        await update.message.reply_text(admission_message(e))
+        return ConversationHandler.END
+    try:
+        return await render_manifest(update, context, document)
+    finally:
+        admission.release(render_pool.workers)
+
+async def render_manifest(update, context, document):
+    """Download, render and deliver the rows of a batch manifest."""
+    user_id = update.message.from_user.id
+    manifest_file = await document.get_file()
+    manifest_data = BytesIO()
+    await manifest_file.download_to_memory(out=manifest_data)
+    try:
+        rows = load_manifest(manifest_data.getvalue().decode('utf-8'), document.file_name or '')
+    except (ValueError, UnicodeDecodeError) as e:
+        await update.message.reply_text(f"Couldn't read the manifest: {e}")
+        return ConversationHandler.END
+    if not rows:
+        await update.message.reply_text("The manifest has no rows.")
+        return ConversationHandler.END
+    if len(rows) > BATCH_MAX_ROWS:
+        await update.message.reply_text(f"A batch can have at most {BATCH_MAX_ROWS} rows.")
+        return ConversationHandler.END
+    # Bad rows are reported with the render failures, the others still render
+    items, errors = manifest_items(rows)
     
-    # Load and process the manga profile picture
-    pfp_img = Image.open(BytesIO(data['manga_pfp']))
+    # Set by /cancel, which also cancels the renders already on the pool
+    stopped = asyncio.Event()
+    batch_jobs.setdefault(user_id, set()).add(stopped)
+    status = await update.message.reply_text(f"Rendering 0/{len(items)}...")
+    results = {}
+    progress = {'done': 0, 'reported': time.time()}
+    slots = asyncio.Semaphore(render_pool.workers)
     
-    # Resize and make circular
-    pfp_size = 300
-    pfp_img = pfp_img.resize((pfp_size, pfp_size))
+    async def report_progress(text):
+        # Progress is only informational, a failed edit mustn't stop the batch
+        try:
+            await status.edit_text(text)
+        except TelegramError as e:
+            logger.warning(f"Could not update batch progress for user {user_id}: {e}")
     
-    # Create circular mask
-    mask = Image.new('L', (pfp_size, pfp_size), 0)
-    draw_mask = ImageDraw.Draw(mask)
-    draw_mask.ellipse((0, 0, pfp_size, pfp_size), fill=255)
+    async def render_item(index, data, image_ref):
+        async with slots:
+            if stopped.is_set():
+                return
+            route = (user_id, 'batch', index)
+            try:
+                image_bytes = await fetch_image(image_ref)
+                # Every profile is cached under its own digest, like a single render
+                data = await render_pool.run(user_id, prepare_batch_item, data, image_bytes, route=route)
+                results[index] = await render_profiles(user_id, data, OUTPUT_PROFILES, route=route)
+            except RenderCancelled:
+                return
+            except Exception as e:
+                errors.append((index, f"row {index + 1}: {e}"))
+        
+        progress['done'] += 1
+        if time.time() - progress['reported'] >= BATCH_PROGRESS_INTERVAL:
+            progress['reported'] = time.time()
+            await report_progress(f"Rendering {progress['done']}/{len(items)}...")
     
-    # Apply mask
-    pfp_img = ImageOps.fit(pfp_img, mask.size, centering=(0.5, 0.5))
-    pfp_img.putalpha(mask)
+    try:
+        await asyncio.gather(*(
+            render_item(index, data, image_ref) for index, data, image_ref in items
+        ))
+    finally:
+        runs = batch_jobs.get(user_id, set())
+        runs.discard(stopped)
+        if not runs:
+            batch_jobs.pop(user_id, None)
+    if stopped.is_set():
+        return ConversationHandler.END
     
-    # Position the profile picture
-    img.paste(pfp_img, (width//2 - pfp_size//2, 50), pfp_img)
+    finished = [(index, data, results[index]) for index, data, _ in items if index in results]
+    await report_progress(f"Rendered {len(finished)}/{len(rows)} thumbnails.")
+    if errors:
+        await update.message.reply_text("Some rows failed:\n" + "\n".join(message for _, message in sorted(errors)[:20]))
     
-    # Add manga name
-    try:
-        font = ImageFont.truetype(f"fonts/{data['text_style']}", FONT_SIZES['title'])
-    except:
-        font = ImageFont.load_default()
+    if context.user_data.get('batch_zip'):
+        # The ZIP gets every output profile
+        rendered = [
+            item for index, data, images in finished
+            for item in batch_files(index, data['manga_name'], images, OUTPUT_PROFILES)
+        ]
+        if rendered:
+            await update.message.reply_document(document=zip_thumbnails(rendered), filename="thumbnails.zip")
+    else:
+        rendered = [(batch_filename(index, data['manga_name']), images['full']) for index, data, images in finished]
+        if len(rendered) == 1:
+            name, image = rendered[0]
+            await update.message.reply_photo(photo=image, filename=name)
+        else:
+            # Telegram albums hold 2 to 10 photos, so split them evenly
+            # rather than leaving a last album of one
+            albums = -(-len(rendered) // 10)
+            for album in range(albums):
+                await update.message.reply_media_group(media=[
+                    InputMediaPhoto(media=image, filename=name)
+                    for name, image in rendered[album * len(rendered) // albums:(album + 1) * len(rendered) // albums]
+                ])
+    return ConversationHandler.END
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show render timings and pool, cache and session usage to admins."""
+    if update.message.from_user.id not in ADMIN_IDS:
+        await update.message.reply_text("This command is only available to bot admins.")
+        return
     
-    manga_name = data['manga_name']
-    draw.text((width//2, 400), manga_name, fill=primary_color, font=font, anchor="mm")
+    lines = [f"Renders: {render_metrics.renders} ok, {render_metrics.failures} failed"]
+    percentiles = render_metrics.percentiles()
+    if percentiles:
+        lines.append(f"\nStage timings, last {render_metrics.window} renders (p50 / p95 / p99 ms):")
+        for stage, (p50, p95, p99, samples) in sorted(percentiles.items()):
+            lines.append(f"{stage}: {p50:.1f} / {p95:.1f} / {p99:.1f} ({samples})")
+    for title, label in (("By template", 'template'), ("By font", 'font')):
+        counts = render_metrics.counts(label)
+        if counts:
+            lines.append(f"\n{title}: " + ", ".join(f"{name} {count}" for name, count in counts.most_common()))
     
-    # Add author and details
-    try:
-        details_font = ImageFont.truetype(f"fonts/{data['text_style']}", FONT_SIZES['details'])
-    except:
-        details_font = ImageFont.load_default()
+    session_stats = await user_sessions.stats()
+    admitted = metrics.totals('admission_jobs_total', 'outcome')
+    lines.append(
+        f"\nRender pool: {render_pool._active}/{render_pool.workers} busy, {len(render_pool._waiters)} queued, "
+        f"{render_pool.restarts} worker restarts"
+        f"\nAdmission: {admission.in_flight}/{admission.budget} in flight, {admitted['accepted']} accepted, "
+        f"{admitted['delayed']} delayed, {admitted['dropped']} dropped"
+        f"\nRender cache: {len(render_cache._images)} images, {render_cache.size // 1024} KB"
+        f"\nSessions: {session_stats['sessions']} live, {session_stats['bytes'] // 1024} KB, "
+        f"{session_stats['expired']} expired, {session_stats['evicted']} evicted"
+    )
+    await update.message.reply_text("\n".join(lines))
+
+def encode_image(img, image_format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY,
+                 preset=THUMBNAIL_PRESET, max_bytes=THUMBNAIL_MAX_BYTES):
+    """Encode an image to bytes in one of OUTPUT_FORMATS using an ENCODER_PRESETS entry.
+    
+    With ``max_bytes`` the highest quality between THUMBNAIL_MIN_QUALITY and
+    ``quality`` that fits the budget is used. If none fits, the image is
+    encoded at the minimum quality anyway.
+    """
+    if image_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported thumbnail format: {image_format}")
+    if preset not in ENCODER_PRESETS:
+        raise ValueError(f"Unknown encoder preset: {preset}")
+    options = ENCODER_PRESETS[preset][image_format]
     
-    details = f"AUTHOR\n{data['author']}\n\nCHAPTERS\n128+ Chapters\n\nTYPE\nManga\n\nYEAR\n{data['year']}"
-    draw.multiline_text((width//2, 480), details, fill='black', font=details_font, anchor="mm", align="center")
+    def encode(quality):
+        buffer = BytesIO()
+        if image_format == "PNG":
+            img.save(buffer, format=image_format, **options)
+        else:
+            img.save(buffer, format=image_format, quality=quality, **options)
+        return buffer.getvalue()
     
-    # Add percentage
-    percentage = data['percentage']
+    encoded = encode(quality)
+    if not max_bytes or len(encoded) <= max_bytes or image_format == "PNG":
+        return encoded
+    
+    # Binary search for the best quality under the budget
+    best = None
+    low, high = min(THUMBNAIL_MIN_QUALITY, quality - 1), quality - 1
+    while low <= high:
+        middle = (low + high) // 2
+        candidate = encode(middle)
+        if len(candidate) <= max_bytes:
+            best = candidate
+            low = middle + 1
+        else:
+            high = middle - 1
+    return best if best is not None else encode(min(THUMBNAIL_MIN_QUALITY, quality))
+
+def parse_output_profiles(spec):
+    """Parse an OUTPUT_PROFILES string into {name: (size, format, quality)}.
+
+    The "full" profile, the thumbnail at canvas size, always comes first.
+    """
+    profiles = {'full': (None, THUMBNAIL_FORMAT, THUMBNAIL_QUALITY)}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        try:
+            name, rest = item.split('=', 1)
+            size, image_format, *quality = rest.split(':')
+            width, height = (int(side) for side in size.lower().split('x'))
+            quality = int(quality[0]) if quality else THUMBNAIL_QUALITY
+        except ValueError:
+            raise ValueError(f"Bad output profile {item!r}, expected name=WIDTHxHEIGHT:FORMAT[:QUALITY]")
+        if image_format.upper() not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported format in output profile {item!r}")
+        profiles[name.strip()] = ((width, height), image_format.upper(), quality)
+    return profiles
+
+OUTPUT_PROFILES = parse_output_profiles(OUTPUT_PROFILES_SPEC)
+
+def derive_variants(master, sizes):
+    """Scale the master down to each of ``sizes``; returns {size: image}.
+
+    A size that divides evenly into the master or a larger variant is made
+    with Image.reduce from the smallest such image, anything else is resized
+    from the master. A size with another aspect ratio gets the centered crop
+    of the master that fits it, instead of a stretched copy.
+    """
+    images = {master.size: master}
+    for size in sorted(set(sizes), key=lambda size: size[0] * size[1], reverse=True):
+        if size in images:
+            continue
+        sources = [
+            image for (width, height), image in images.items()
+            if width % size[0] == 0 and height % size[1] == 0 and width // size[0] == height // size[1]
+        ]
+        if sources:
+            source = min(sources, key=lambda image: image.width)
+            images[size] = source.reduce(source.width // size[0])
+        else:
+            # Center crop to the target aspect ratio and resize in one resample
+            scale = min(master.width / size[0], master.height / size[1])
+            left = (master.width - size[0] * scale) / 2
+            top = (master.height - size[1] * scale) / 2
+            images[size] = master.resize(
+                size, Image.LANCZOS, box=(left, top, master.width - left, master.height - top), reducing_gap=3.0
+            )
+    return images
+
+def encode_profiles(master, profiles):
+    """Encode the master at every output profile; returns {name: image bytes}."""
+    images = derive_variants(master, [size for size, _, _ in profiles.values() if size is not None])
+    return {
+        name: encode_image(images[size or master.size], image_format, quality)
+        for name, (size, image_format, quality) in profiles.items()
+    }
+
+def file_digest(path):
+    """SHA-256 of a file's contents, or None when it can't be read."""
     try:
-        percent_font = ImageFont.truetype(f"fonts/{data['text_style']}", FONT_SIZES['percentage'])
-    except:
-        percent_font = ImageFont.load_default()
+        stat = os.stat(path)
+    except OSError:
+        return None
+    # A replaced file gets a new mtime or size, so it is hashed again
+    return _file_digest(path, stat.st_mtime_ns, stat.st_size)
+
+@functools.lru_cache(maxsize=64)
+def _file_digest(path, mtime_ns, size):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def thumbnail_digest(data, image_format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY, size=None):
+    """Return a stable hex digest of everything that affects the rendered thumbnail."""
+    fields = {field: data.get(field) for field in THUMBNAIL_FIELDS}
+    fields['manga_pfp'] = hashlib.sha256(data['manga_pfp']).hexdigest()
+    # What the names stand for: the renderer, the resolved template and the font file
+    fields['render'] = [
+        RENDER_VERSION, template_plan(data['template_style']).digest,
+        file_digest(f"fonts/{data['text_style']}")
+    ]
+    fields['output'] = [image_format, quality, THUMBNAIL_PRESET, THUMBNAIL_MAX_BYTES]
+    if size is not None:
+        fields['output'].append(list(size))
+    payload = json.dumps(fields, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+@functools.lru_cache(maxsize=8)
+def circle_mask(size):
+    """Return the circular alpha mask for an avatar of ``size`` pixels."""
+    mask = Image.new('L', (size, size), 0)
+    draw_mask = ImageDraw.Draw(mask)
+    draw_mask.ellipse((0, 0, size, size), fill=255)
+    return mask
+
+def square_avatar(image_bytes, size, max_pixels=None):
+    """Decode a cover image and return its centered square as ``size`` x ``size`` RGB.
     
-    draw.text((width//2, 650), f"{percentage}%", fill=primary_color, font=percent_font, anchor="mm")
+    JPEGs are decoded at a reduced scale where possible, then the square is
+    cropped and resampled in a single pass. Raises ValueError when the image
+    is larger than ``max_pixels``, which is checked before anything is decoded.
+    """
+    pfp_img = Image.open(BytesIO(image_bytes))
+    if max_pixels is not None and pfp_img.width * pfp_img.height > max_pixels:
+        raise ValueError(f"Cover image is too large: {pfp_img.width}x{pfp_img.height}")
     
-    # Add progress bar
-    bar_width = 400
-    bar_height = 20
-    bar_x = width//2 - bar_width//2
-    bar_y = 690
+    pfp_img.draft('RGB', (size, size))
+    if pfp_img.mode != 'RGB':
+        pfp_img = pfp_img.convert('RGB')
     
-    # Background bar
-    draw.rectangle([bar_x, bar_y, bar_x + bar_width, bar_y + bar_height], outline=primary_color, width=2)
+    # Center square crop and resize in one resample
+    src_width, src_height = pfp_img.size
+    side = min(src_width, src_height)
+    left = (src_width - side) / 2
+    top = (src_height - side) / 2
+    return pfp_img.resize(
+        (size, size), Image.LANCZOS, box=(left, top, left + side, top + side), reducing_gap=3.0
+    )
+
+def normalize_avatar(image_bytes, size):
+    """Reduce an uploaded cover to the avatar square and return it as compact JPEG bytes."""
+    pfp_img = square_avatar(image_bytes, size, max_pixels=MAX_COVER_PIXELS)
+    buffer = BytesIO()
+    pfp_img.save(buffer, format='JPEG', quality=95)
+    return buffer.getvalue()
+
+def cover_palette(image_bytes):
+    """Return the cover's quantized palette as (share, (r, g, b)), most common first.
     
-    # Filled bar
-    fill_width = int(bar_width * percentage / 100)
-    draw.rectangle([bar_x, bar_y, bar_x + fill_width, bar_y + bar_height], fill=primary_color)
+    Palettes are memoized by the SHA-256 of the image, so a cover that was
+    already seen is not decoded again.
+    """
+    digest = hashlib.sha256(image_bytes).digest()
+    with _palette_lock:
+        if digest in _palette_cache:
+            _palette_cache.move_to_end(digest)
+            return _palette_cache[digest]
     
-    # Add synopsis
-    synopsis_text = data['synopsis']
-    wrapped_text = textwrap.fill(synopsis_text, width=40)
+    img = Image.open(BytesIO(image_bytes))
+    img.draft('RGB', (AUTO_COLOR_SAMPLE, AUTO_COLOR_SAMPLE))
+    img = img.convert('RGB')
+    img.thumbnail((AUTO_COLOR_SAMPLE, AUTO_COLOR_SAMPLE), Image.BOX)
+    quantized = img.quantize(AUTO_COLOR_PALETTE, method=Image.Quantize.MEDIANCUT)
+    colors = quantized.getpalette()
+    total = img.width * img.height
+    palette = tuple(
+        (count / total, tuple(colors[index * 3:index * 3 + 3]))
+        for count, index in sorted(quantized.getcolors(), reverse=True)
+    )
     
-    try:
-        synopsis_font = ImageFont.truetype(f"fonts/{data['text_style']}", FONT_SIZES['synopsis'])
-    except:
-        synopsis_font = ImageFont.load_default()
+    with _palette_lock:
+        _palette_cache[digest] = palette
+        while len(_palette_cache) > COVER_PALETTE_CACHE_SIZE:
+            _palette_cache.popitem(last=False)
+    return palette
+
+_palette_cache = OrderedDict()
+_palette_lock = threading.Lock()
+
+def relative_luminance(rgb):
+    """WCAG relative luminance of an sRGB color."""
+    def linear(channel):
+        channel /= 255
+        return channel / 12.92 if channel <= 0.03928 else ((channel + 0.055) / 1.055) ** 2.4
+    r, g, b = (linear(channel) for channel in rgb)
+    return 0.2126 * r + 0.7152 * g + 0.0722 * b
+
+def contrast_ratio(first, second):
+    """WCAG contrast ratio between two sRGB colors, from 1 to 21."""
+    lighter, darker = sorted((relative_luminance(first), relative_luminance(second)), reverse=True)
+    return (lighter + 0.05) / (darker + 0.05)
+
+def auto_color(image_bytes, background):
+    """Pick a hex color from the cover that stands out against ``background``.
+    
+    Palette colors are weighted by how much of the cover they cover and by
+    their saturation, so a strong accent can win over a large dull area.
+    Black or white is used when no color reaches the contrast minimum.
+    """
+    best, best_score = None, 0
+    for share, rgb in cover_palette(image_bytes):
+        if contrast_ratio(rgb, background) < AUTO_COLOR_MIN_CONTRAST:
+            continue
+        saturation = (max(rgb) - min(rgb)) / 255
+        score = share * (0.2 + saturation)
+        if score > best_score:
+            best, best_score = rgb, score
+    if best is None:
+        best = max(((0, 0, 0), (255, 255, 255)), key=lambda rgb: contrast_ratio(rgb, background))
+    return "#{:02x}{:02x}{:02x}".format(*best)
+
+def load_avatar(image_bytes, size):
+    """Decode a cover image into a circular ``size`` x ``size`` RGBA avatar."""
+    pfp_img = square_avatar(image_bytes, size)
+    pfp_img.putalpha(circle_mask(size))
+    return pfp_img
+
+@functools.lru_cache(maxsize=TEXT_MEASURE_CACHE_SIZE)
+def text_width(font_path, size, text):
+    """Return the advance width of a single line of text in pixels."""
+    return font_registry.get(font_path, size).getlength(text)
+
+@functools.lru_cache(maxsize=64)
+def line_height(font_path, size):
+    """Return the distance between the tops of two lines, as multiline_text spaces them."""
+    return font_registry.get(font_path, size).getbbox("A")[3] + LINE_SPACING
+
+def ellipsis_for(font_path, size):
+    # The bitmap default font has no "…" glyph
+    font = font_registry.get(font_path, size)
+    return "…" if isinstance(font, ImageFont.FreeTypeFont) else "..."
+
+def truncate_text(font_path, size, text, max_width):
+    """Cut ``text`` with an ellipsis so that it fits in ``max_width``."""
+    if text_width(font_path, size, text) <= max_width:
+        return text
+    ellipsis = ellipsis_for(font_path, size)
+    # Longest prefix that still fits with the ellipsis
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if text_width(font_path, size, text[:middle].rstrip() + ellipsis) <= max_width:
+            low = middle
+        else:
+            high = middle - 1
+    # Cut at a word boundary when there is one
+    if low < len(text) and not text[low].isspace() and " " in text[:low]:
+        low = text.rindex(" ", 0, low)
+    return text[:low].rstrip() + ellipsis
+
+def split_word(font_path, size, word, max_width):
+    """Break a word that is wider than a line into pieces that fit."""
+    pieces = []
+    while word:
+        low, high = 1, len(word)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if text_width(font_path, size, word[:middle]) <= max_width:
+                low = middle
+            else:
+                high = middle - 1
+        pieces.append(word[:low])
+        word = word[low:]
+    return pieces
+
+def wrap_text(font_path, size, text, max_width):
+    """Wrap text into lines no wider than ``max_width``, measured in the font.
+
+    Each word is measured on its own, so its width is cached for every other
+    text using it, and a line's width is the sum of its words and spaces.
+    """
+    space = text_width(font_path, size, " ")
+    lines = []
+    for paragraph in str(text).split("\n"):
+        line, width = "", 0
+        for word in paragraph.split():
+            word_width = text_width(font_path, size, word)
+            if line and width + space + word_width <= max_width:
+                line, width = f"{line} {word}", width + space + word_width
+                continue
+            if line:
+                lines.append(line)
+            line, width = word, word_width
+            if word_width > max_width:
+                *pieces, line = split_word(font_path, size, word, max_width)
+                lines.extend(pieces)
+                width = text_width(font_path, size, line)
+        lines.append(line)
+    return lines
+
+@functools.lru_cache(maxsize=TEXT_LAYOUT_CACHE_SIZE)
+def fit_text(font_path, text, box_width, box_height, max_size, min_size, max_lines=None):
+    """Find the largest font size at which ``text`` wraps into the box.
+
+    Returns (size, lines). When the text doesn't fit even at ``min_size``,
+    the lines that fit are kept and the last one ends with an ellipsis.
+    """
+    def fits(lines, size):
+        if max_lines is not None and len(lines) > max_lines:
+            return False
+        return len(lines) * line_height(font_path, size) - LINE_SPACING <= box_height
+
+    # Most text fits at the full size, which needs a single wrap
+    lines = wrap_text(font_path, max_size, text, box_width)
+    if fits(lines, max_size):
+        return max_size, tuple(lines)
+
+    best = None
+    low, high = min_size, max_size - 1
+    while low <= high:
+        size = (low + high) // 2
+        lines = wrap_text(font_path, size, text, box_width)
+        if fits(lines, size):
+            best = (size, tuple(lines))
+            low = size + 1
+        else:
+            high = size - 1
+    if best is not None:
+        return best
+
+    lines = wrap_text(font_path, min_size, text, box_width)
+    keep = max(1, (box_height + LINE_SPACING) // line_height(font_path, min_size))
+    if max_lines is not None:
+        keep = min(keep, max_lines)
+    kept = lines[:keep]
+    if len(lines) > keep:
+        kept[-1] = truncate_text(font_path, min_size, f"{kept[-1]} {lines[keep]}", box_width)
+    return min_size, tuple(kept)
+
+def draw_lines(draw, xy, lines, font_path, size, fill, anchor):
+    """Draw lines centred on ``xy[0]``, spaced like multiline_text.
+
+    ``anchor`` is "mm" to centre the block on ``xy[1]`` or "ma" to hang it
+    from there. Line widths are already known from the layout, so unlike
+    multiline_text nothing is measured again.
+    """
+    font = font_registry.get(font_path, size)
+    spacing = line_height(font_path, size)
+    x, top = xy
+    if anchor[1] == "m":
+        top -= (len(lines) - 1) * spacing / 2.0
+    if not isinstance(font, ImageFont.FreeTypeFont):
+        # The bitmap default font ignores anchors and draws from the top left
+        if anchor[1] == "m":
+            top -= (spacing - LINE_SPACING) / 2.0
+        for line in lines:
+            draw.text((x - text_width(font_path, size, line) / 2.0, top), line, fill=fill, font=font)
+            top += spacing
+        return
+    for line in lines:
+        draw.text((x, top), line, fill=fill, font=font, anchor=anchor)
+        top += spacing
+
+@functools.lru_cache(maxsize=16)
+def gradient_background(size, top_color, bottom_color):
+    """Return a vertical gradient from ``top_color`` to ``bottom_color``."""
+    mask = Image.linear_gradient('L').resize(size)
+    return Image.composite(
+        Image.new('RGB', size, bottom_color), Image.new('RGB', size, top_color), mask
+    )
+
+@functools.lru_cache(maxsize=4)
+def grain_texture(size):
+    """Return a mid-gray noise texture; overlaying it adds film grain."""
+    return Image.effect_noise(size, 40).convert('RGB')
+
+def add_grain(img, amount):
+    return Image.blend(img, ImageChops.overlay(img, grain_texture(img.size)), amount)
+
+def apply_tone(img, tone):
+    """Apply a colour tone ("sepia" or "muted") to an RGB or RGBA image."""
+    alpha = img.getchannel('A') if img.mode == 'RGBA' else None
+    rgb = img.convert('RGB')
+    if tone == 'sepia':
+        gray = rgb.convert('L')
+        rgb = Image.merge('RGB', [gray.point(lut) for lut in SEPIA_LUTS])
+    elif tone == 'muted':
+        rgb = ImageEnhance.Color(rgb).enhance(0.6)
+    else:
+        raise ValueError(f"unknown tone {tone!r}")
+    if alpha is not None:
+        rgb.putalpha(alpha)
+    return rgb
+
+@functools.lru_cache(maxsize=GLOW_CACHE_SIZE)
+def glow_mask(layer, font_path, size, lines, canvas_size):
+    """Return (mask, offset) of a blurred copy of a text layer's lines.
     
-    draw.multiline_text((width//2, 750), wrapped_text, fill='black', font=synopsis_font, anchor="mm", align="center")
+    Only the area around the text is blurred, and masks are cached, so the
+    glow of a repeated title costs a single paste.
+    """
+    mask = Image.new('L', canvas_size)
+    layer.draw_lines(ImageDraw.Draw(mask), font_path, size, lines, 255)
+    bbox = mask.getbbox()
+    if bbox is None:
+        return None, (0, 0)
+    pad = layer.glow['radius'] * 3
+    left, top = max(0, bbox[0] - pad), max(0, bbox[1] - pad)
+    right, bottom = min(canvas_size[0], bbox[2] + pad), min(canvas_size[1], bbox[3] + pad)
+    region = mask.crop((left, top, right, bottom)).filter(ImageFilter.GaussianBlur(layer.glow['radius']))
+    strength = layer.glow.get('strength', 2)
+    region = region.point(lambda level: min(255, int(level * strength)))
+    return region, (left, top)
+
+class TextLayer:
+    """A text layer of a compiled template.
+
+    Text with a ``box`` is wrapped and shrunk to fit the box. Text at an
+    ``xy`` point is drawn at its fixed size, and its lines without
+    placeholders go into the static layer.
+    """
+
+    def __init__(self, spec):
+        self.text = spec['text']
+        self.size = spec['size']
+        self.min_size = spec.get('min_size', self.size)
+        self.color = spec.get('color', 'black')
+        self.max_lines = spec.get('max_lines')
+        self.max_width = spec.get('max_width')
+        self.fields = {name for _, name, _, _ in string.Formatter().parse(self.text) if name}
+        unknown = self.fields - set(TEMPLATE_FIELDS)
+        if unknown:
+            raise ValueError(f"unknown fields {sorted(unknown)} in text {self.text!r}")
+
+        self.glow = spec.get('glow')
+        self.box = tuple(spec['box']) if 'box' in spec else None
+        self.align = spec.get('align', 'center')
+        if self.box is not None:
+            left, top, width, height = self.box
+            if spec.get('valign', 'top') == 'middle':
+                self.xy, self.anchor = (left + width//2, top + height//2), "mm"
+            else:
+                self.xy, self.anchor = (left + width//2, top), "ma"
+            self.static_lines = ()
+        else:
+            self.xy = tuple(spec['xy'])
+            self.anchor = spec.get('anchor', 'mm')
+            lines = self.text.split("\n")
+            self.static_lines = tuple("" if "{" in line else line for line in lines)
+            self.dynamic_lines = tuple(line if "{" in line else "" for line in lines)
+            if not any(self.static_lines):
+                self.static_lines = ()
+
+    def draw_static(self, draw, font_path, primary_color):
+        if self.static_lines:
+            self.draw(draw, (self.size, self.static_lines), font_path, primary_color)
+
+    def layout(self, data, font_path):
+        """Return (font size, lines) for this layer's text."""
+        if self.box is None:
+            values = {name: str(data[name]).replace("\n", " ") for name in self.fields}
+            lines = tuple(line.format(**values) for line in self.dynamic_lines)
+            if self.max_width is not None:
+                lines = tuple(truncate_text(font_path, self.size, line, self.max_width) for line in lines)
+            return self.size, lines
+        text = self.text.format(**{name: data[name] for name in self.fields})
+        return fit_text(font_path, text, self.box[2], self.box[3], self.size, self.min_size, self.max_lines)
+
+    def draw(self, draw, layout, font_path, primary_color):
+        size, lines = layout
+        if self.glow:
+            mask, offset = glow_mask(self, font_path, size, lines, draw.im.size)
+            if mask is not None:
+                glow_color = self.glow.get('color', 'primary')
+                draw.bitmap(offset, mask, fill=primary_color if glow_color == 'primary' else glow_color)
+        self.draw_lines(draw, font_path, size, lines, primary_color if self.color == 'primary' else self.color)
+
+    def draw_lines(self, draw, font_path, size, lines, fill):
+        if self.align != 'right':
+            draw_lines(draw, self.xy, lines, font_path, size, fill, self.anchor)
+            return
+        # Right aligned against the edge of the box
+        font = font_registry.get(font_path, size)
+        left, top, width, _ = self.box
+        for line in lines:
+            bbox = draw.textbbox((0, 0), line, font=font)
+            draw.text((left + width - (bbox[2] - bbox[0]), top), line, fill=fill, font=font)
+            top += line_height(font_path, size)
+
+class BarLayer:
+    """A progress bar layer: the outline is static, the fill follows a field."""
+
+    def __init__(self, spec):
+        self.box = tuple(spec['box'])
+        self.value = spec.get('value', 'percentage')
+        self.outline = spec.get('outline', 2)
+        self.color = spec.get('color', 'primary')
+        if self.value not in TEMPLATE_FIELDS:
+            raise ValueError(f"unknown bar value {self.value!r}")
+
+    def draw_static(self, draw, font_path, primary_color):
+        left, top, width, height = self.box
+        fill = primary_color if self.color == 'primary' else self.color
+        draw.rectangle([left, top, left + width, top + height], outline=fill, width=self.outline)
+
+    def layout(self, data, font_path):
+        return int(self.box[2] * data[self.value] / 100)
+
+    def draw(self, draw, layout, font_path, primary_color):
+        left, top, _, height = self.box
+        fill = primary_color if self.color == 'primary' else self.color
+        draw.rectangle([left, top, left + layout, top + height], fill=fill)
+
+# Layer classes by the "type" used in template specs
+LAYER_TYPES = {
+    'text': TextLayer,
+    'bar': BarLayer
+}
+
+class TemplatePlan:
+    """A template spec compiled into the layers generate_thumbnail draws.
+
+    Specs are checked and turned into layer objects once, when the templates
+    load; a render only runs each layer's layout() and draw().
+    """
+
+    def __init__(self, style, spec, directory):
+        self.style = style
+        self.name = spec.get('name', style)
+        canvas = spec['canvas']
+        self.size = tuple(canvas['size'])
+        self.background = canvas.get('background', 'white')
+        self.background_image = None
+        # Identifies this exact layout in thumbnail digests
+        self.digest = hashlib.sha256(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()
+        if canvas.get('image'):
+            self.digest = hashlib.sha256(
+                (self.digest + str(file_digest(os.path.join(directory, canvas['image'])))).encode('utf-8')
+            ).hexdigest()
+            with Image.open(os.path.join(directory, canvas['image'])) as image:
+                self.background_image = image.convert('RGB')
+            if self.background_image.size != self.size:
+                self.background_image = self.background_image.resize(self.size, Image.LANCZOS)
+        self.avatar_xy = tuple(spec['avatar']['xy'])
+        self.avatar_size = spec['avatar']['size']
+        self.layers = [LAYER_TYPES[layer['type']](layer) for layer in spec['layers']]
+        # fit_text may pick any size between a layer's min_size and size
+        self.font_sizes = {
+            size for layer in self.layers if isinstance(layer, TextLayer)
+            for size in range(layer.min_size, layer.size + 1)
+        }
+        
+        # Whole-image effects, drawn into the cached static layer. The tone
+        # applies to a background image and to each avatar.
+        effects = spec.get('effects', {})
+        self.gradient = tuple(effects['gradient']) if 'gradient' in effects else None
+        self.tone = effects.get('tone')
+        self.grain = effects.get('grain', 0)
+        self.frame = effects.get('frame')
+        if self.tone is not None:
+            apply_tone(Image.new('RGB', (1, 1)), self.tone)
+        
+        # Average background color, for contrast checks on "Auto" colors;
+        # a "primary" gradient stop counts as mid gray
+        self.backdrop = self.new_canvas('#808080').resize((1, 1), Image.BOX).getpixel((0, 0))
+
+    def new_canvas(self, primary_color):
+        """Return the background with its effects, before any layer is drawn."""
+        if self.background_image is not None:
+            img = self.background_image.copy()
+            if self.tone is not None:
+                img = apply_tone(img, self.tone)
+        elif self.gradient is not None:
+            top, bottom = (primary_color if color == 'primary' else color for color in self.gradient)
+            img = gradient_background(self.size, top, bottom).copy()
+        else:
+            img = Image.new('RGB', self.size, color=self.background)
+        if self.grain:
+            img = add_grain(img, self.grain)
+        if self.frame is not None:
+            inset, width = self.frame.get('inset', 16), self.frame.get('width', 2)
+            color = self.frame.get('color', 'primary')
+            ImageDraw.Draw(img).rectangle(
+                [inset, inset, self.size[0] - 1 - inset, self.size[1] - 1 - inset],
+                outline=primary_color if color == 'primary' else color, width=width
+            )
+        return img
+
+def load_template_specs(directory):
+    """Read every ``<style>.json`` in ``directory``, resolving "extends"."""
+    raw = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.json'):
+            with open(os.path.join(directory, filename)) as f:
+                raw[filename[:-len('.json')]] = json.load(f)
+    
+    def resolve(style, seen):
+        spec = dict(raw[style])
+        parent = spec.pop('extends', None)
+        if parent is None:
+            return spec
+        if parent in seen or parent not in raw:
+            raise ValueError(f"extends missing or circular template {parent!r}")
+        merged = resolve(parent, seen | {style})
+        for key, value in spec.items():
+            # Canvas and avatar settings are merged, anything else is replaced
+            if isinstance(value, dict) and isinstance(merged.get(key), dict):
+                value = {**merged[key], **value}
+            merged[key] = value
+        return merged
+    
+    specs = {}
+    for style in raw:
+        try:
+            specs[style] = resolve(style, set())
+        except ValueError as e:
+            logger.error(f"Skipping template {style}: {e}")
+    return specs
+
+def load_templates(directory):
+    """Compile the template specs in ``directory``; a default template is required."""
+    plans = {}
+    for style, spec in load_template_specs(directory).items():
+        try:
+            plans[style] = TemplatePlan(style, spec, directory)
+        except (KeyError, TypeError, ValueError, OSError) as e:
+            logger.error(f"Skipping template {style}: {e!r}")
+    if 'default' not in plans:
+        raise RuntimeError(f"No usable default template in {directory}")
+    return plans
+
+def template_plan(style):
+    """Return the compiled template for a style, or the default for unknown ones."""
+    return template_plans.get(style) or template_plans['default']
+
+template_plans = load_templates(TEMPLATES_DIR)
+for plan in sorted(template_plans.values(), key=lambda plan: plan.name):
+    TEMPLATES[plan.name] = plan.style
+    TEMPLATE_AVATAR_SIZES[plan.style] = plan.avatar_size
+
+def build_static_layer(template_style, primary_color, text_style):
+    """Draw the parts of a thumbnail that don't depend on the user's text."""
+    plan = template_plan(template_style)
+    img = plan.new_canvas(primary_color)
+    draw = ImageDraw.Draw(img)
+    font_path = f"fonts/{text_style}"
+    for layer in plan.layers:
+        layer.draw_static(draw, font_path, primary_color)
+    return img
+
+def generate_thumbnail(user_id, data, image_format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY, profiles=None):
+    """Generate the manga thumbnail based on user preferences.
+    
+    Returns the encoded image bytes. ``data`` is the session's answers, since
+    a render worker has no access to ``user_sessions``.
+    With ``profiles`` (see parse_output_profiles) the image is rendered once and
+    {profile name: image bytes} is returned instead.
+    """
+    timer = current_timer()
+    plan = template_plan(data['template_style'])
+    primary_color = data['color_scheme']
+    font_path = f"fonts/{data['text_style']}"
+    
+    # Start from a copy of the cached static layer
+    with timer.stage('template'):
+        img = static_layers.get(data['template_style'], primary_color, data['text_style'])
+        draw = ImageDraw.Draw(img)
+    
+    # Load the manga profile picture as a circle
+    with timer.stage('avatar'):
+        pfp_img = load_avatar(data['manga_pfp'], plan.avatar_size)
+        if plan.tone is not None:
+            pfp_img = apply_tone(pfp_img, plan.tone)
+        img.paste(pfp_img, plan.avatar_xy, pfp_img)
+    
+    # Lay out the text of every layer
+    with timer.stage('layout'):
+        layouts = [layer.layout(data, font_path) for layer in plan.layers]
+    
+    with timer.stage('text'):
+        for layer, layout in zip(plan.layers, layouts):
+            layer.draw(draw, layout, font_path, primary_color)
+    
+    # Encode the image in memory
+    with timer.stage('encode'):
+        if profiles is not None:
+            return encode_profiles(img, profiles)
+        return encode_image(img, image_format, quality)
+
+def load_manifest(text, filename):
+    """Parse a batch manifest. Files ending in .csv are CSV, anything else is JSONL."""
+    if filename.lower().endswith('.csv'):
+        # Quoted fields may span lines, so let the csv module split them
+        return list(csv.DictReader(StringIO(text, newline='')))
+    
+    rows = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"line {number} is not valid JSON ({e.msg})")
+        if not isinstance(row, dict):
+            raise ValueError(f"line {number} is not a JSON object")
+        rows.append(row)
+    return rows
+
+def manifest_row_to_data(row, number):
+    """Turn a manifest row into (session data, image reference).
+    
+    template, color and font accept the keyboard labels ("Style 1 - Default",
+    "Red", "Bold") as well as raw values (a template name, hex color or font file).
+    """
+    def field(name, default=None):
+        value = row.get(name)
+        if value is None or str(value).strip() == '':
+            if default is None:
+                raise ValueError(f"row {number} is missing {name}")
+            return default
+        return str(value).strip()
     
-    # Add branding
-    branding_text = data['branding']
     try:
-        branding_font = ImageFont.truetype(f"fonts/{data['text_style']}", FONT_SIZES['branding'])
-    except:
-        branding_font = ImageFont.load_default()
+        percent = int(field('percentage'))
+        year = int(field('year'))
+    except ValueError:
+        raise ValueError(f"row {number}: percentage and year must be whole numbers")
+    if percent < 0 or percent > 100:
+        raise ValueError(f"row {number}: percentage must be between 0 and 100")
+    
+    template = field('template', 'default')
+    color = field('color', 'Black')
+    if color == 'Random':
+        color = "#{:06x}".format(random.randint(0, 0xFFFFFF))
+    else:
+        color = COLORS.get(color, color)
+        # "Custom" has no value of its own and a typo would only fail mid-render
+        if color != 'auto':
+            try:
+                ImageColor.getrgb(color)
+            except ValueError:
+                raise ValueError(f"row {number}: unknown color {field('color')!r}")
+    font = field('font', 'Standard')
     
-    # Position branding in top right
-    bbox = draw.textbbox((0, 0), branding_text, font=branding_font)
-    text_width = bbox[2] - bbox[0]
-    text_height = bbox[3] - bbox[1]
-    draw.text((width - text_width - 20, 20), branding_text, fill=primary_color, font=branding_font)
+    data = {
+        'manga_name': field('manga_name'),
+        'synopsis': field('synopsis', ''),
+        'percentage': percent,
+        'year': year,
+        'author': field('author', ''),
+        'template_style': TEMPLATES.get(template, template if template in TEMPLATES.values() else 'default'),
+        'color_scheme': color,
+        'text_style': FONTS.get(font, font if font in FONTS.values() else 'arial.ttf'),
+        'branding': field('branding', ''),
+    }
+    return data, field('image')
+
+def manifest_items(rows):
+    """Validate every manifest row on its own.
     
-    # Save the image
-    filename = f"thumbnail_{user_id}.jpg"
-    img.save(filename)
+    Returns (items, errors): (row index, session data, image reference) for
+    the good rows and (row index, message) for the bad ones.
+    """
+    items, errors = [], []
+    for index, row in enumerate(rows):
+        try:
+            items.append((index, *manifest_row_to_data(row, index + 1)))
+        except ValueError as e:
+            errors.append((index, str(e)))
+    return items, errors
+
+async def fetch_image(url):
+    """Download a manifest image over http(s), refusing anything over MAX_COVER_BYTES."""
+    if not url.startswith(('http://', 'https://')):
+        raise ValueError("image must be an http(s) URL")
     
-    return filename
+    async with httpx.AsyncClient(timeout=30, follow_redirects=True) as client:
+        async with client.stream('GET', url) as response:
+            response.raise_for_status()
+            body = bytearray()
+            async for chunk in response.aiter_bytes():
+                body.extend(chunk)
+                if len(body) > MAX_COVER_BYTES:
+                    raise ValueError("image is too large")
+    return bytes(body)
+
+def read_image(image_ref, base_dir):
+    """Load a manifest image from a URL or a path relative to the manifest."""
+    if image_ref.startswith(('http://', 'https://')):
+        response = httpx.get(image_ref, timeout=30, follow_redirects=True)
+        response.raise_for_status()
+        return response.content
+    with open(os.path.join(base_dir, image_ref), 'rb') as f:
+        return f.read()
+
+def prepare_batch_item(data, image_bytes):
+    """Return a manifest row's data with its image normalized and "auto" color picked.
+
+    Runs on a render worker. The result is what thumbnail_digest() hashes, so
+    cached renders of the row can be found before rendering it.
+    """
+    data = dict(data)
+    plan = template_plan(data['template_style'])
+    with current_timer().stage('normalize'):
+        data['manga_pfp'] = normalize_avatar(image_bytes, plan.avatar_size)
+    if data['color_scheme'] == 'auto':
+        data['color_scheme'] = auto_color(data['manga_pfp'], plan.backdrop)
+    return data
+
+def render_batch_item(data, image_bytes, profiles):
+    """Normalize a manifest image and render its profiles; runs on a render worker."""
+    return generate_thumbnail(None, prepare_batch_item(data, image_bytes), profiles=profiles)
+
+def render_batch_file_item(data, image_ref, base_dir, profiles):
+    return render_batch_item(data, read_image(image_ref, base_dir), profiles)
+
+def batch_filename(index, manga_name, profile='full', image_format=THUMBNAIL_FORMAT):
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', manga_name).strip('_')[:40] or 'thumbnail'
+    suffix = "" if profile == 'full' else f"_{profile}"
+    return f"{index + 1:03d}_{slug}{suffix}.{OUTPUT_FORMATS[image_format]}"
+
+def batch_files(index, manga_name, images, profiles):
+    """Name each rendered profile of a batch row; returns (filename, image bytes) pairs."""
+    return [
+        (batch_filename(index, manga_name, name, profiles[name][1]), image)
+        for name, image in images.items()
+    ]
+
+def zip_thumbnails(rendered):
+    """Pack (filename, image bytes) pairs into an in-memory ZIP."""
+    buffer = BytesIO()
+    # Images are already compressed, so just store them
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for name, image in rendered:
+            archive.writestr(name, image)
+    return buffer.getvalue()
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log errors caused by Updates."""
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
 
+async def flush_sessions() -> None:
+    """Write buffered session changes even while no updates arrive."""
+    while True:
+        await asyncio.sleep(SESSION_FLUSH_INTERVAL)
+        await user_sessions.flush()
+
+async def start_session_flusher(application: Application) -> None:
+    application.create_task(flush_sessions())
+
+def batch_cli(argv) -> int:
+    """Render a manifest from the command line, no Telegram token needed."""
+    parser = argparse.ArgumentParser(
+        prog='main.py batch', description="Render manga thumbnails from a JSONL or CSV manifest."
+    )
+    parser.add_argument('manifest', help="manifest file (.jsonl or .csv)")
+    parser.add_argument(
+        '-o', '--output', default='thumbnails',
+        help="output directory, or a file ending in .zip (default: thumbnails)"
+    )
+    parser.add_argument(
+        '-p', '--profiles', default=OUTPUT_PROFILES_SPEC,
+        help="extra sizes to write, e.g. grid=400x500:WEBP,card=200x250:WEBP (default: $OUTPUT_PROFILES)"
+    )
+    args = parser.parse_args(argv)
+    try:
+        profiles = parse_output_profiles(args.profiles)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    with open(args.manifest, encoding='utf-8', newline='') as f:
+        rows = load_manifest(f.read(), args.manifest)
+    items, errors = manifest_items(rows)
+    for _, message in errors:
+        print(message, file=sys.stderr)
+    base_dir = os.path.dirname(os.path.abspath(args.manifest))
+    
+    font_registry.preload()
+    executor = render_pool.executor
+    futures = {
+        executor.submit(render_batch_file_item, data, image_ref, base_dir, profiles): (index, data)
+        for index, data, image_ref in items
+    }
+    
+    rendered = []
+    failed = len(errors)
+    for done, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+        index, data = futures[future]
+        name = batch_filename(index, data['manga_name'])
+        try:
+            rendered.extend(batch_files(index, data['manga_name'], future.result(), profiles))
+            print(f"[{done}/{len(items)}] {name}")
+        except Exception as e:
+            failed += 1
+            print(f"[{done}/{len(items)}] row {index + 1} failed: {e}", file=sys.stderr)
+    executor.shutdown()
+    
+    rendered.sort()
+    if args.output.lower().endswith('.zip'):
+        with open(args.output, 'wb') as f:
+            f.write(zip_thumbnails(rendered))
+    else:
+        os.makedirs(args.output, exist_ok=True)
+        for name, image in rendered:
+            with open(os.path.join(args.output, name), 'wb') as f:
+                f.write(image)
+    print(f"Rendered {len(rows) - failed}/{len(rows)} thumbnails to {args.output}")
+    return 1 if failed else 0
+
+def menu_pattern(options):
+    """Regex matching exactly one of the keyboard labels in ``options``."""
+    return f'^({"|".join(re.escape(label) for label in options)})$'
+
 def main() -> None:
     """Run the bot."""
     # Get the bot token from environment variable
@@ -409,8 +3231,18 @@ def main() -> None:
         logger.error("No BOT_TOKEN environment variable found!")
         return
     
+    # Load fonts up front for the render threads; worker processes load their own
+    font_registry.preload()
+    
     # Create the Application and pass it your bot's token
-    application = Application.builder().token(token).build()
+    builder = Application.builder().token(token).request(BotRequest())
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(UserOrderedUpdateProcessor(CONCURRENT_UPDATES))
+    if session_db is not None:
+        # Keep conversation states next to the sessions so they survive restarts
+        builder = builder.persistence(SQLitePersistence(session_db, SESSION_FLUSH_INTERVAL))
+        builder = builder.post_init(start_session_flusher)
+    application = builder.build()
 
     # Add conversation handler with the states
     conv_handler = ConversationHandler(
@@ -422,31 +3254,53 @@ def main() -> None:
             PERCENTAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, percentage)],
             YEAR: [MessageHandler(filters.TEXT & ~filters.COMMAND, year)],
             AUTHOR: [MessageHandler(filters.TEXT & ~filters.COMMAND, author)],
-            TEMPLATE_STYLE: [MessageHandler(filters.Regex(f'^({"|".join(TEMPLATES.keys())})$'), template_style)],
+            TEMPLATE_STYLE: [MessageHandler(filters.Regex(menu_pattern(TEMPLATES)), template_style)],
             COLOR_SCHEME: [
-                MessageHandler(filters.Regex(f'^({"|".join(COLORS.keys())})$'), color_scheme),
+                MessageHandler(filters.Regex(menu_pattern(COLORS)), color_scheme),
             ],
             CUSTOM_COLOR: [MessageHandler(filters.TEXT & ~filters.COMMAND, custom_color)],
-            TEXT_STYLE: [MessageHandler(filters.Regex(f'^({"|".join(FONTS.keys())})$'), text_style)],
+            TEXT_STYLE: [MessageHandler(filters.Regex(menu_pattern(FONTS)), text_style)],
             BRANDING: [MessageHandler(filters.TEXT & ~filters.COMMAND, branding)],
-            CONFIRMATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirmation)],
+            # Non-blocking so a render doesn't hold up updates from other chats
+            CONFIRMATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirmation, block=False)],
+            # Lets /cancel reach a render that is still queued or running
+            ConversationHandler.WAITING: [CommandHandler('cancel', cancel)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='thumbnail',
+        persistent=session_db is not None,
+    )
+
+    batch_handler = ConversationHandler(
+        entry_points=[CommandHandler('batch', batch)],
+        states={
+            BATCH_MANIFEST: [MessageHandler(filters.Document.ALL, batch_manifest, block=False)],
+            ConversationHandler.WAITING: [CommandHandler('cancel', cancel)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
     )
 
     application.add_handler(conv_handler)
+    application.add_handler(batch_handler)
+    application.add_handler(CommandHandler('stats', stats))
     application.add_error_handler(error_handler)
 
     # Start the Bot
     port = int(os.environ.get('PORT', 8443))
+    metrics_port = int(METRICS_PORT) if METRICS_PORT else port + 1
+    if metrics_port:
+        start_metrics_server(METRICS_HOST, metrics_port)
     webhook_url = os.getenv('WEBHOOK_URL', f"https://your-app-name.onrender.com")
     
     application.run_webhook(
         listen="0.0.0.0",
         port=port,
         url_path=token,
-        webhook_url=f"{webhook_url}/{token}"
+        webhook_url=f"{webhook_url}/{token}",
+        max_connections=WEBHOOK_MAX_CONNECTIONS
     )
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['batch']:
+        sys.exit(batch_cli(sys.argv[2:]))
     main()
@@ -1,5 +1,10 @@
 import os
 import logging
+import asyncio
+import time
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
@@ -8,7 +13,6 @@ from PIL import Image, ImageDraw, ImageFont, ImageOps
 import textwrap
 from io import BytesIO
 import random
-from datetime import datetime
 
 # Enable logging
 logging.basicConfig(
@@ -67,17 +71,230 @@ FONT_SIZES = {
     "branding": 20
 }
 
+# Render worker pool settings
+RENDER_EXECUTOR = os.getenv('RENDER_EXECUTOR', 'thread')  # "thread" or "process"
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', min(4, os.cpu_count() or 1)))
+RENDER_QUEUE_SIZE = int(os.getenv('RENDER_QUEUE_SIZE', 32))
+RENDER_TIMEOUT = float(os.getenv('RENDER_TIMEOUT', 60))
+
+# Session expiry settings
+SESSION_TTL = float(os.getenv('SESSION_TTL', 3600))
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_BYTES', 64 * 1024 * 1024))
+SESSION_SWEEP_INTERVAL = float(os.getenv('SESSION_SWEEP_INTERVAL', 30))
+
+class SessionStore:
+    """In-memory user sessions with idle expiry and a memory cap.
+
+    Sessions are kept in order of last activity. A sweep drops sessions idle
+    for longer than ``ttl`` and then the least recently active ones until the
+    bytes held fall under ``max_bytes``. Sweeps run on every new session and
+    at most every ``sweep_interval`` seconds on lookups.
+    """
+
+    def __init__(self, ttl, max_bytes, sweep_interval):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.expired = 0
+        self.evicted = 0
+        self._sessions = OrderedDict()
+        self._last_sweep = time.time()
+
+    def new(self, user_id):
+        """Start a fresh session for a user and return it."""
+        now = time.time()
+        session = {'data': {}, 'created_at': now, 'last_activity': now}
+        self._sessions.pop(user_id, None)
+        self._sessions[user_id] = session
+        self.sweep()
+        return session
+
+    def __contains__(self, user_id):
+        return user_id in self._sessions
+
+    def __getitem__(self, user_id):
+        session = self._sessions[user_id]
+        session['last_activity'] = time.time()
+        self._sessions.move_to_end(user_id)
+        if session['last_activity'] - self._last_sweep > self.sweep_interval:
+            self.sweep()
+        return session
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def pop(self, user_id, default=None):
+        return self._sessions.pop(user_id, default)
+
+    @staticmethod
+    def session_size(session):
+        """Approximate bytes held by a session's text and image data."""
+        return sum(len(value) for value in session['data'].values() if isinstance(value, (bytes, str)))
+
+    def bytes_held(self):
+        return sum(self.session_size(session) for session in self._sessions.values())
+
+    def sweep(self):
+        """Drop idle sessions, then the oldest ones while over the memory cap."""
+        now = time.time()
+        self._last_sweep = now
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if now - session['last_activity'] <= self.ttl:
+                break
+            del self._sessions[user_id]
+            self.expired += 1
+        
+        held = self.bytes_held()
+        # Never evict the session that is currently active
+        while held > self.max_bytes and len(self._sessions) > 1:
+            _, session = self._sessions.popitem(last=False)
+            held -= self.session_size(session)
+            self.evicted += 1
+
+    def stats(self):
+        return {
+            'sessions': len(self._sessions),
+            'bytes': self.bytes_held(),
+            'expired': self.expired,
+            'evicted': self.evicted
+        }
+
 # User session data
-user_sessions = {}
+user_sessions = SessionStore(SESSION_TTL, SESSION_MAX_BYTES, SESSION_SWEEP_INTERVAL)
+
+def with_session(handler):
+    """End the conversation politely when the user's session has expired."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        if update.message.from_user.id not in user_sessions:
+            await update.message.reply_text(
+                "Your session has expired. Send /start to begin again.",
+                reply_markup=ReplyKeyboardRemove()
+            )
+            return ConversationHandler.END
+        return await handler(update, context)
+    return wrapper
+
+class RenderQueueFull(Exception):
+    """Raised when every render worker is busy and the wait queue is full."""
+
+class RenderCancelled(Exception):
+    """Raised when a user cancels a render that is queued or running."""
+
+class RenderPool:
+    """Runs thumbnail renders off the event loop with a bounded wait queue.
+
+    At most ``workers`` renders run at once; up to ``queue_size`` more wait in
+    FIFO order and anything beyond that is rejected with RenderQueueFull.
+    A worker slot is only freed once its render has really finished, so a job
+    that timed out or was cancelled still counts against the pool until the
+    worker returns.
+    """
+
+    def __init__(self, workers, queue_size, timeout, use_processes=False):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.use_processes = use_processes
+        self._executor = None
+        self._active = 0
+        self._waiters = OrderedDict()  # job token -> future resolved when a slot is handed over
+        self._cancels = {}  # job token -> future resolved by cancel()
+        self._jobs = {}  # user_id -> tokens of that user's queued and running jobs
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.use_processes:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='render')
+        return self._executor
+
+    def cancel(self, user_id):
+        """Cancel every queued or running render of a user. Returns True if there was one."""
+        found = False
+        for token in self._jobs.get(user_id, ()):
+            cancelled = self._cancels[token]
+            if not cancelled.done():
+                cancelled.set_result(None)
+                found = True
+        return found
+
+    async def run(self, user_id, func, *args, on_queued=None):
+        """Run ``func(*args)`` on a worker and return its result.
+
+        ``on_queued`` is awaited with the queue position when the job has to
+        wait for a free worker.
+        """
+        loop = asyncio.get_running_loop()
+        token = object()
+        cancelled = self._cancels[token] = loop.create_future()
+        self._jobs.setdefault(user_id, set()).add(token)
+        try:
+            await self._acquire(token, cancelled, on_queued)
+            job = loop.run_in_executor(self.executor, func, *args)
+            job.add_done_callback(self._release)
+            done, _ = await asyncio.wait(
+                {job, cancelled}, timeout=self.timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if job in done:
+                return job.result()
+            if cancelled in done:
+                raise RenderCancelled()
+            raise asyncio.TimeoutError()
+        finally:
+            del self._cancels[token]
+            tokens = self._jobs[user_id]
+            tokens.discard(token)
+            if not tokens:
+                del self._jobs[user_id]
+
+    async def _acquire(self, token, cancelled, on_queued):
+        if self._active < self.workers and not self._waiters:
+            self._active += 1
+            return
+        if len(self._waiters) >= self.queue_size:
+            raise RenderQueueFull()
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[token] = waiter
+        try:
+            if on_queued is not None:
+                await on_queued(len(self._waiters))
+            # A queued job gives up after the render timeout too
+            await asyncio.wait({waiter, cancelled}, timeout=self.timeout, return_when=asyncio.FIRST_COMPLETED)
+            if cancelled.done() and not waiter.done():
+                raise RenderCancelled()
+            if not waiter.done():
+                raise asyncio.TimeoutError()
+        except BaseException:
+            self._waiters.pop(token, None)
+            if waiter.done() and not waiter.cancelled():
+                # A slot was already handed to us, pass it on
+                self._release()
+            waiter.cancel()
+            raise
+
+    def _release(self, _job=None):
+        # Hand the slot straight to the next waiter so new arrivals can't jump the queue
+        while self._waiters:
+            _, waiter = self._waiters.popitem(last=False)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+render_pool = RenderPool(
+    RENDER_WORKERS, RENDER_QUEUE_SIZE, RENDER_TIMEOUT,
+    use_processes=(RENDER_EXECUTOR == 'process')
+)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Start the conversation and ask for the manga name."""
     user_id = update.message.from_user.id
-    user_sessions[user_id] = {
-        'step': MANGA_NAME,
-        'data': {},
-        'created_at': datetime.now()
-    }
+    user_sessions.new(user_id)
     
     await update.message.reply_text(
         "🎌 Welcome to Manga Thumbnail Generator! 🎌\n\n"
@@ -86,6 +303,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return MANGA_NAME
 
+@with_session
 async def manga_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the manga name and ask for the manga profile picture."""
     user_id = update.message.from_user.id
@@ -96,6 +314,7 @@ async def manga_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return MANGA_PFP
 
+@with_session
 async def manga_pfp(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the manga profile picture and ask for synopsis."""
     user_id = update.message.from_user.id
@@ -111,6 +330,7 @@ async def manga_pfp(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return SYNOPSIS
 
+@with_session
 async def synopsis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the synopsis and ask for percentage."""
     user_id = update.message.from_user.id
@@ -121,6 +341,7 @@ async def synopsis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return PERCENTAGE
 
+@with_session
 async def percentage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the percentage and ask for year."""
     user_id = update.message.from_user.id
@@ -138,6 +359,7 @@ async def percentage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return YEAR
 
+@with_session
 async def year(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the year and ask for author."""
     user_id = update.message.from_user.id
@@ -153,6 +375,7 @@ async def year(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return AUTHOR
 
+@with_session
 async def author(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the author and ask for template style."""
     user_id = update.message.from_user.id
@@ -167,6 +390,7 @@ async def author(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return TEMPLATE_STYLE
 
+@with_session
 async def template_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the template style and ask for color scheme."""
     user_id = update.message.from_user.id
@@ -181,6 +405,7 @@ async def template_style(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     )
     return COLOR_SCHEME
 
+@with_session
 async def color_scheme(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the color scheme and ask for text style."""
     user_id = update.message.from_user.id
@@ -208,6 +433,7 @@ async def color_scheme(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     )
     return TEXT_STYLE
 
+@with_session
 async def custom_color(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle custom color input."""
     user_id = update.message.from_user.id
@@ -229,6 +455,7 @@ async def custom_color(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     )
     return TEXT_STYLE
 
+@with_session
 async def text_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the text style and ask for branding."""
     user_id = update.message.from_user.id
@@ -240,6 +467,7 @@ async def text_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return BRANDING
 
+@with_session
 async def branding(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the branding and show confirmation."""
     user_id = update.message.from_user.id
@@ -264,17 +492,29 @@ async def branding(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text(summary)
     return CONFIRMATION
 
+@with_session
 async def confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle confirmation and generate thumbnail."""
     user_id = update.message.from_user.id
     response = update.message.text.lower()
     
+    # The conversation ends here either way, so the session can go
+    data = user_sessions.pop(user_id)['data']
+    
     if response == 'yes':
         await update.message.reply_text("Generating your manga thumbnail... Please wait.")
         
-        # Generate the thumbnail
+        async def notify_queued(position):
+            await update.message.reply_text(
+                f"All renderers are busy right now, you're queued, position {position}."
+            )
+        
+        # Generate the thumbnail on the render pool so other chats aren't blocked
         try:
-            thumbnail_path = generate_thumbnail(user_id)
+            thumbnail_path = await render_pool.run(
+                user_id, generate_thumbnail, user_id, data,
+                on_queued=notify_queued
+            )
             
             # Send the generated image
             with open(thumbnail_path, 'rb') as photo:
@@ -283,6 +523,14 @@ async def confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             # Clean up
             os.remove(thumbnail_path)
             
+        except RenderQueueFull:
+            await update.message.reply_text("The bot is very busy right now. Please try again in a minute.")
+        except RenderCancelled:
+            # /cancel already answered the user
+            pass
+        except asyncio.TimeoutError:
+            logger.error(f"Thumbnail render for user {user_id} timed out after {render_pool.timeout}s")
+            await update.message.reply_text("Sorry, generating your thumbnail took too long. Please try again.")
         except Exception as e:
             logger.error(f"Error generating thumbnail: {e}")
             await update.message.reply_text("Sorry, there was an error generating your thumbnail. Please try again.")
@@ -295,14 +543,23 @@ async def confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancel the conversation."""
+    user_id = update.message.from_user.id
+    render_pool.cancel(user_id)
+    user_sessions.pop(user_id, None)
+    
     await update.message.reply_text(
         'Thumbnail generation cancelled.', reply_markup=ReplyKeyboardRemove()
     )
     return ConversationHandler.END
 
-def generate_thumbnail(user_id):
-    """Generate the manga thumbnail based on user preferences."""
-    data = user_sessions[user_id]['data']
+def generate_thumbnail(user_id, data=None):
+    """Generate the manga thumbnail based on user preferences.
+    
+    ``data`` is passed explicitly when running on a render worker process,
+    which has no access to ``user_sessions``.
+    """
+    if data is None:
+        data = user_sessions[user_id]['data']
     
     # Create a blank image
     width, height = 800, 1000
@@ -433,7 +690,10 @@ def main() -> None:
             CUSTOM_COLOR: [MessageHandler(filters.TEXT & ~filters.COMMAND, custom_color)],
             TEXT_STYLE: [MessageHandler(filters.Regex(f'^({"|".join(FONTS.keys())})$'), text_style)],
             BRANDING: [MessageHandler(filters.TEXT & ~filters.COMMAND, branding)],
-            CONFIRMATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirmation)],
+            # Non-blocking so a render doesn't hold up updates from other chats
+            CONFIRMATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirmation, block=False)],
+            # Lets /cancel reach a render that is still queued or running
+            ConversationHandler.WAITING: [CommandHandler('cancel', cancel)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
     )
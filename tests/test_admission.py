@@ -0,0 +1,160 @@
+import asyncio
+from unittest import mock
+
+import pytest
+from telegram.error import TelegramError
+
+import main
+from main import AdmissionControl, AdmissionRejected, TokenBuckets
+
+
+def test_bucket_allows_burst_then_waits():
+    buckets = TokenBuckets(per_minute=60, burst=2)
+    for _ in range(2):
+        assert buckets.wait('user', 100.0) == 0
+        buckets.take('user', 100.0)
+    assert buckets.wait('user', 100.0) == pytest.approx(1.0)
+
+
+def test_bucket_debt_delays_later_callers():
+    buckets = TokenBuckets(per_minute=60, burst=1)
+    buckets.take('user', 100.0)
+    # A caller that waits for its token takes it up front and leaves a debt
+    buckets.take('user', 100.0)
+    assert buckets.wait('user', 100.0) == pytest.approx(2.0)
+    assert buckets.wait('user', 101.0) == pytest.approx(1.0)
+    assert buckets.wait('user', 102.0) == 0
+
+
+def test_bucket_refills_up_to_burst():
+    buckets = TokenBuckets(per_minute=60, burst=2)
+    buckets.take('user', 100.0)
+    buckets.take('user', 100.0)
+    for _ in range(2):
+        buckets.take('user', 1000.0)
+    assert buckets.wait('user', 1000.0) == pytest.approx(1.0)
+
+
+def test_bucket_without_rate_never_waits():
+    buckets = TokenBuckets(per_minute=0, burst=1)
+    buckets.take('user', 100.0)
+    assert buckets.wait('user', 100.0) == 0
+
+
+def admission_control(per_minute=600, burst=5, budget=2, max_delay=1):
+    return AdmissionControl(TokenBuckets(per_minute, burst), TokenBuckets(per_minute, burst), budget, max_delay)
+
+
+def test_admission_holds_budget_until_release():
+    async def scenario():
+        admission = admission_control(budget=2)
+        await admission.acquire(1, 10, 'test')
+        await admission.acquire(2, 20, 'test')
+        with pytest.raises(AdmissionRejected) as rejected:
+            await admission.acquire(3, 30, 'test')
+        assert rejected.value.reason == 'busy'
+        admission.release()
+        await admission.acquire(3, 30, 'test')
+        assert admission.in_flight == 2
+
+    asyncio.run(scenario())
+
+
+def test_admission_drops_user_over_rate():
+    async def scenario():
+        admission = admission_control(per_minute=6, burst=1, max_delay=1)
+        await admission.acquire(1, 10, 'test')
+        admission.release()
+        with pytest.raises(AdmissionRejected) as rejected:
+            await admission.acquire(1, 10, 'test')
+        assert rejected.value.reason == 'user'
+        assert admission.in_flight == 0
+
+    asyncio.run(scenario())
+
+
+def test_admission_cancelled_while_delayed_releases_units():
+    async def scenario():
+        admission = admission_control(per_minute=60, burst=1, max_delay=5)
+        await admission.acquire(1, 10, 'test')
+        admission.release()
+        waiting = asyncio.create_task(admission.acquire(1, 10, 'test'))
+        await asyncio.sleep(0.05)
+        assert admission.in_flight == 1
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert admission.in_flight == 0
+
+    asyncio.run(scenario())
+
+
+def confirm_update(user_id):
+    update = mock.MagicMock()
+    update.message.from_user.id = user_id
+    update.message.chat_id = user_id
+    update.message.text = 'yes'
+    update.message.reply_text = mock.AsyncMock()
+    update.message.reply_photo = mock.AsyncMock()
+    return update
+
+
+async def confirm(update, render=None, during_delay=None, admission=None):
+    """Run the confirmation handler with a fresh admission control and a stubbed render."""
+    context = mock.MagicMock()
+    context.user_data = {}
+    admission = admission or admission_control()
+    render = render or mock.AsyncMock(return_value={'full': b'image'})
+    with mock.patch.object(main, 'admission', admission), \
+            mock.patch.object(main, 'render_profiles', render), \
+            mock.patch.object(main, 'render_cache', main.RenderCache(1024)), \
+            mock.patch.object(main, 'thumbnail_digest', lambda data: 'digest'):
+        task = asyncio.create_task(main.confirmation(update, context))
+        if during_delay is not None:
+            await asyncio.sleep(0.05)
+            await during_delay()
+        try:
+            return await task
+        finally:
+            assert admission.in_flight == 0
+
+
+@pytest.mark.parametrize('render', [
+    mock.AsyncMock(return_value={'full': b'image'}),
+    mock.AsyncMock(side_effect=ValueError('bad render')),
+    mock.AsyncMock(side_effect=main.RenderQueueFull()),
+    mock.AsyncMock(side_effect=asyncio.TimeoutError()),
+    mock.AsyncMock(side_effect=main.RenderCancelled()),
+], ids=['sent', 'error', 'queue-full', 'timeout', 'cancelled'])
+def test_confirmation_releases_admission(render):
+    async def scenario():
+        await main.user_sessions.new(41)
+        assert await confirm(confirm_update(41), render) == main.ConversationHandler.END
+        assert not await main.user_sessions.exists(41)
+
+    asyncio.run(scenario())
+
+
+def test_confirmation_releases_admission_when_reply_fails():
+    async def scenario():
+        await main.user_sessions.new(42)
+        update = confirm_update(42)
+        update.message.reply_text.side_effect = TelegramError('chat not found')
+        with pytest.raises(TelegramError):
+            await confirm(update)
+
+    asyncio.run(scenario())
+
+
+def test_confirmation_releases_admission_when_session_expires_during_delay():
+    async def scenario():
+        await main.user_sessions.new(43)
+        admission = admission_control(per_minute=600, burst=1, max_delay=5)
+        await admission.acquire(43, 43, 'test')
+        admission.release()
+        update = confirm_update(43)
+        result = await confirm(update, admission=admission, during_delay=lambda: main.user_sessions.pop(43))
+        assert result == main.ConversationHandler.END
+        update.message.reply_text.assert_awaited_with("Your session has expired. Send /start to begin again.")
+
+    asyncio.run(scenario())
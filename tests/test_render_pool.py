@@ -0,0 +1,110 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from main import RenderCancelled, RenderPool, RenderQueueFull
+
+
+def blocking_job(started, release, result):
+    started.set()
+    release.wait(5)
+    return result
+
+
+def test_queued_jobs_run_in_arrival_order():
+    async def scenario():
+        pool = RenderPool(workers=1, queue_size=10, timeout=5)
+        order = []
+
+        def job(name):
+            order.append(name)
+            time.sleep(0.01)
+            return name
+
+        jobs = [asyncio.create_task(pool.run(user_id, job, user_id)) for user_id in range(5)]
+        assert await asyncio.gather(*jobs) == list(range(5))
+        assert order == list(range(5))
+
+    asyncio.run(scenario())
+
+
+def test_jobs_of_one_user_dont_replace_each_other():
+    async def scenario():
+        pool = RenderPool(workers=1, queue_size=10, timeout=5)
+        jobs = [asyncio.create_task(pool.run(1, lambda i=i: i)) for i in range(3)]
+        assert await asyncio.gather(*jobs) == [0, 1, 2]
+        assert not pool._waiters and not pool._cancels and not pool._jobs
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_is_rejected():
+    async def scenario():
+        pool = RenderPool(workers=1, queue_size=1, timeout=5)
+        started, release = threading.Event(), threading.Event()
+        running = asyncio.create_task(pool.run(1, blocking_job, started, release, 'a'))
+        queued = asyncio.create_task(pool.run(2, lambda: 'b'))
+        await asyncio.sleep(0.05)
+        with pytest.raises(RenderQueueFull):
+            await pool.run(3, lambda: 'c')
+        release.set()
+        assert await asyncio.gather(running, queued) == ['a', 'b']
+
+    asyncio.run(scenario())
+
+
+def test_cancel_stops_queued_and_running_jobs_of_a_user():
+    async def scenario():
+        pool = RenderPool(workers=1, queue_size=10, timeout=5)
+        started, release = threading.Event(), threading.Event()
+        running = asyncio.create_task(pool.run(1, blocking_job, started, release, 'a'))
+        queued = asyncio.create_task(pool.run(1, lambda: 'b'))
+        other = asyncio.create_task(pool.run(2, lambda: 'c'))
+        await asyncio.sleep(0.05)
+
+        assert pool.cancel(1)
+        for job in (running, queued):
+            with pytest.raises(RenderCancelled):
+                await job
+        assert not pool.cancel(1)
+        # The cancelled job's worker is only freed once it really finishes
+        assert not other.done()
+        release.set()
+        assert await other == 'c'
+        assert pool._active == 0
+
+    asyncio.run(scenario())
+
+
+def test_running_job_times_out():
+    async def scenario():
+        pool = RenderPool(workers=1, queue_size=10, timeout=0.1)
+        started, release = threading.Event(), threading.Event()
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.run(1, blocking_job, started, release, 'a')
+        assert pool._active == 1
+        release.set()
+        await asyncio.sleep(0.05)
+        assert pool._active == 0
+
+    asyncio.run(scenario())
+
+
+def test_queued_job_times_out():
+    async def scenario():
+        pool = RenderPool(workers=1, queue_size=10, timeout=0.1)
+        started, release = threading.Event(), threading.Event()
+        running = asyncio.create_task(pool.run(1, blocking_job, started, release, 'a'))
+        await asyncio.sleep(0.01)
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.run(2, lambda: 'b')
+        assert not pool._waiters
+        release.set()
+        with pytest.raises(asyncio.TimeoutError):
+            await running
+        await asyncio.sleep(0.05)
+        assert await pool.run(3, lambda: 'c') == 'c'
+
+    asyncio.run(scenario())
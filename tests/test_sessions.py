@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+from main import SQLiteDatabase, SQLiteSessionStore
+
+
+def open_store(path, flush_interval=3600, batch_size=1000):
+    # Each store has its own connection and write buffers, like a separate bot process
+    return SQLiteSessionStore(SQLiteDatabase(str(path)), 3600, 10**9, 3600, flush_interval, batch_size)
+
+
+def test_field_writes_from_two_processes_are_merged(tmp_path):
+    async def scenario():
+        first, second = open_store(tmp_path / 'sessions.db'), open_store(tmp_path / 'sessions.db')
+        await first.new(1)
+        await first.flush()
+        assert await second.exists(1)
+
+        await first.set(1, 'manga_name', 'One Piece')
+        await second.set(1, 'manga_pfp', b'\x89PNG')
+        await second.set(1, 'year', 1997)
+        await asyncio.gather(first.flush(), second.flush())
+
+        for store in (first, second):
+            assert (await store.get(1))['data'] == {'manga_name': 'One Piece', 'manga_pfp': b'\x89PNG', 'year': 1997}
+
+    asyncio.run(scenario())
+
+
+def test_buffered_fields_are_visible_before_flush(tmp_path):
+    async def scenario():
+        store = open_store(tmp_path / 'sessions.db')
+        await store.new(1)
+        await store.set(1, 'author', 'Oda')
+        assert (await store.get(1))['data'] == {'author': 'Oda'}
+        assert not await open_store(tmp_path / 'sessions.db').exists(1)
+
+    asyncio.run(scenario())
+
+
+def test_session_ended_elsewhere_drops_late_fields(tmp_path):
+    async def scenario():
+        first, second = open_store(tmp_path / 'sessions.db'), open_store(tmp_path / 'sessions.db')
+        await first.new(1)
+        await first.flush()
+        await second.set(1, 'author', 'Oda')
+        await first.pop(1)
+        await first.flush()
+        await second.flush()
+
+        assert not await first.exists(1)
+        with pytest.raises(KeyError):
+            await second.get(1)
+
+    asyncio.run(scenario())
+
+
+def test_failed_flush_keeps_changes_for_the_next_one(tmp_path):
+    async def scenario():
+        store = open_store(tmp_path / 'sessions.db')
+        await store.new(1)
+        await store.set(1, 'author', 'Oda')
+        real_write = store._write
+
+        def failing_write(*args):
+            raise OSError('disk full')
+
+        store._write = failing_write
+        with pytest.raises(OSError):
+            await store.flush()
+        store._write = real_write
+        await store.flush()
+
+        assert (await open_store(tmp_path / 'sessions.db').get(1))['data'] == {'author': 'Oda'}
+
+    asyncio.run(scenario())